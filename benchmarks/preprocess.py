@@ -0,0 +1,379 @@
+#!/usr/bin/python3
+"""Benchmarks for the preprocessing hot paths, run on synthetic slides.
+
+Each case runs in a fresh process so its peak memory is not affected by the
+cases that ran before it. Results are written as json so that runs from
+different commits can be compared, e.g.
+
+    python benchmarks/preprocess.py run --sizes 16384,65536 --output new.json
+    python benchmarks/preprocess.py compare old.json new.json
+"""
+
+import json
+import multiprocessing
+import platform
+import resource
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from itertools import product
+from pathlib import Path
+from statistics import median
+from typing import Callable, Dict, List, NamedTuple
+
+import numpy as np
+from click import argument, group, option
+
+from pathgen.data.datasets.registry import register_dataset
+from pathgen.data.datasets.synthetic import make_synthetic
+from pathgen.preprocess.patching import GridPatchFinder, PatchSet, index_slide
+from pathgen.preprocess.sampling import sample
+from pathgen.preprocess.tissue_detection import (
+    TissueDetectorOTSU,
+    TissueDetectorOTSUFast,
+    TissueDetectorOTSUTiled,
+)
+from pathgen.utils.convert import to_frame_with_locations
+from pathgen.utils.filters import pool2d, pool2d_fractions
+from pathgen.utils.geometry import Size
+
+PATCH_SIZE = 256
+PATCH_LEVEL = 0
+
+
+class Params(NamedTuple):
+    slide_size: int  # the width of level 0, the height is three quarters of it
+    labels_level: int
+    stride: int
+    patch_count: int
+
+
+# a case takes the parameters, does any setup, and returns a function to time
+# which returns the number of items it processed
+Case = Callable[[Params], Callable[[], int]]
+cases = {}
+case_params = {}
+
+
+def case(*params: str):
+    """Register a benchmark case that depends on the given parameters."""
+
+    def register(fn: Case) -> Case:
+        cases[fn.__name__] = fn
+        case_params[fn.__name__] = params
+        return fn
+
+    return register
+
+
+def make_dataset(p: Params):
+    width = p.slide_size
+    size = Size(width, width * 3 // 4)
+    num_levels = max(p.labels_level + 1, int(np.log2(width)) - 6)
+    dataset = make_synthetic(f"bench_{width}", 1, 0, size=size, num_levels=num_levels)
+    register_dataset(dataset)
+    return dataset
+
+
+def make_labels_image(p: Params) -> np.ndarray:
+    dataset = make_dataset(p)
+    slide_path, annotation_path, _, _ = dataset[0]
+    with dataset.slide_cls(slide_path) as slide:
+        shape = slide.dimensions[p.labels_level].as_shape()
+        annotations = dataset.load_annotations(annotation_path)
+        labels_image = annotations.render(shape, 2 ** p.labels_level)
+        tissue_mask = TissueDetectorOTSU()(slide.get_thumbnail(p.labels_level))
+    labels_image[~tissue_mask] = 0
+    return labels_image
+
+
+def make_finder(p: Params) -> GridPatchFinder:
+    return GridPatchFinder(p.labels_level, PATCH_LEVEL, PATCH_SIZE, p.stride)
+
+
+def make_patchset(p: Params) -> PatchSet:
+    dataset = make_dataset(p)
+    return index_slide(0, dataset, TissueDetectorOTSU(), make_finder(p))
+
+
+@case("slide_size", "labels_level", "stride")
+def pool2d_max(p: Params) -> Callable[[], int]:
+    labels_image = make_labels_image(p)
+    scale_factor = 2 ** (p.labels_level - PATCH_LEVEL)
+    kernel_size = max(1, PATCH_SIZE // scale_factor)
+    stride = max(1, p.stride // scale_factor)
+    return lambda: pool2d(labels_image, kernel_size, stride, 0).size
+
+
+@case("slide_size", "labels_level", "stride")
+def pool2d_area_fractions(p: Params) -> Callable[[], int]:
+    labels_image = make_labels_image(p)
+    scale_factor = 2 ** (p.labels_level - PATCH_LEVEL)
+    kernel_size = max(1, PATCH_SIZE // scale_factor)
+    stride = max(1, p.stride // scale_factor)
+    # count the windows, like pool2d_max
+    return lambda: pool2d_fractions(labels_image, kernel_size, stride)[:, :, 0].size
+
+
+@case("slide_size", "labels_level", "stride")
+def frame_with_locations(p: Params) -> Callable[[], int]:
+    labels_image = make_labels_image(p)
+    scale_factor = 2 ** (p.labels_level - PATCH_LEVEL)
+    kernel_size = max(1, PATCH_SIZE // scale_factor)
+    stride = max(1, p.stride // scale_factor)
+    pooled = pool2d(labels_image, kernel_size, stride, 0)
+    return lambda: len(to_frame_with_locations(pooled, "label"))
+
+
+@case("slide_size", "labels_level")
+def render_annotations(p: Params) -> Callable[[], int]:
+    dataset = make_dataset(p)
+    slide_path, annotation_path, _, _ = dataset[0]
+    with dataset.slide_cls(slide_path) as slide:
+        shape = slide.dimensions[p.labels_level].as_shape()
+    annotations = dataset.load_annotations(annotation_path)
+    return lambda: annotations.render(shape, 2 ** p.labels_level).size
+
+
+@case("slide_size", "labels_level")
+def tissue_detector_otsu(p: Params) -> Callable[[], int]:
+    dataset = make_dataset(p)
+    with dataset.slide_cls(dataset[0][0]) as slide:
+        thumbnail = slide.get_thumbnail(p.labels_level)
+    detector = TissueDetectorOTSU()
+    return lambda: detector(thumbnail).size
+
+
+@case("slide_size", "labels_level")
+def tissue_detector_otsu_fast(p: Params) -> Callable[[], int]:
+    dataset = make_dataset(p)
+    with dataset.slide_cls(dataset[0][0]) as slide:
+        thumbnail = slide.get_thumbnail(p.labels_level)
+    detector = TissueDetectorOTSUFast()
+    return lambda: detector(thumbnail).size
+
+
+@case("slide_size", "labels_level")
+def tissue_detector_tiled(p: Params) -> Callable[[], int]:
+    # includes reading the slide twice, unlike the cases above
+    dataset = make_dataset(p)
+    slide = dataset.slide_cls(dataset[0][0])
+    detector = TissueDetectorOTSUTiled(memmap=True)
+    return lambda: detector.detect_slide(slide, p.labels_level).size
+
+
+@case("slide_size", "labels_level", "stride")
+def grid_patch_finder(p: Params) -> Callable[[], int]:
+    labels_image = make_labels_image(p)
+    finder = make_finder(p)
+    size = Size(p.slide_size, p.slide_size * 3 // 4)
+    return lambda: len(finder(labels_image, size)[0])
+
+
+@case("slide_size", "labels_level", "stride")
+def index_synthetic_slide(p: Params) -> Callable[[], int]:
+    dataset = make_dataset(p)
+    detector, finder = TissueDetectorOTSU(), make_finder(p)
+    return lambda: len(index_slide(0, dataset, detector, finder).df)
+
+
+@case("slide_size", "patch_count")
+def sample_patches(p: Params) -> Callable[[], int]:
+    patchset = make_patchset(p._replace(labels_level=4, stride=PATCH_SIZE))
+    # repeat the patches so there are always enough to sample from, the sampling
+    # policy weights by slide so needs the slide index as a column
+    patchset.df = patchset.df.loc[np.repeat(patchset.df.index, 8)]
+    patchset.df = patchset.df.reset_index(drop=True)
+    patchset.df["slide_index"] = patchset._slide_index
+    return lambda: len(sample(patchset, p.patch_count, floor_samples=0).df)
+
+
+@case("slide_size", "patch_count")
+def export_patches(p: Params) -> Callable[[], int]:
+    patchset = make_patchset(p._replace(labels_level=4, stride=PATCH_SIZE))
+    rows = np.random.RandomState(0).choice(len(patchset.df), p.patch_count)
+    patchset.df = patchset.df.iloc[rows].reset_index(drop=True)
+
+    def run() -> int:
+        output_dir = Path(tempfile.mkdtemp())
+        try:
+            patchset.export(output_dir)
+        finally:
+            shutil.rmtree(output_dir)
+        return len(patchset.df)
+
+    return run
+
+
+def current_rss() -> int:
+    # resident set size in bytes, from /proc on linux
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize()
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class PeakRSS:
+    """Samples the resident set size on a thread to find the peak while it is active."""
+
+    def __init__(self, interval: float = 0.002) -> None:
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+
+    def _sample(self) -> None:
+        while not self._stop.is_set():
+            self.peak = max(self.peak, current_rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self) -> "PeakRSS":
+        self.peak = current_rss()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+def run_case(name: str, p: Params, repeat: int) -> Dict:
+    run = cases[name](p)
+    baseline = current_rss()
+    times = []
+    with PeakRSS() as peak:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            items = run()
+            times.append(time.perf_counter() - start)
+    return {
+        "items": items,
+        "wall_time_s": min(times),
+        "wall_time_median_s": median(times),
+        "throughput_per_s": items / min(times) if min(times) > 0 else None,
+        "peak_rss_mb": peak.peak / 2 ** 20,
+        "peak_rss_increase_mb": (peak.peak - baseline) / 2 ** 20,
+    }
+
+
+def run_case_isolated(name: str, p: Params, repeat: int) -> Dict:
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(1) as pool:
+        return pool.apply(run_case, (name, p, repeat))
+
+
+def git_commit() -> str:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            cwd=Path(__file__).parent,
+        )
+        return out.stdout.decode().strip() or "unknown"
+    except OSError:
+        return "unknown"
+
+
+def parse_ints(values: str) -> List[int]:
+    return [int(v) for v in values.split(",") if v]
+
+
+@group()
+def main():
+    pass
+
+
+@main.command()
+@option("--sizes", default="16384", help="Comma separated level 0 slide widths.")
+@option("--labels-levels", default="4", help="Comma separated labels levels.")
+@option("--strides", default="256", help="Comma separated strides at the patch level.")
+@option("--patch-counts", default="200", help="Comma separated patch counts.")
+@option("--repeat", default=3, help="Times to run each case, the fastest is reported.")
+@option("--cases", "names", default="", help="Comma separated cases, default all.")
+@option(
+    "--output",
+    default="",
+    help="Results file, default pathgen-benchmarks/<commit>.json in the temp dir",
+)
+def run(sizes, labels_levels, strides, patch_counts, repeat, names, output):
+    """Run the benchmarks and write the results to a json file."""
+    grid = {
+        "slide_size": parse_ints(sizes),
+        "labels_level": parse_ints(labels_levels),
+        "stride": parse_ints(strides),
+        "patch_count": parse_ints(patch_counts),
+    }
+    defaults = Params(*(values[0] for values in grid.values()))
+    names = [n for n in names.split(",") if n] or list(cases.keys())
+
+    results = []
+    for name in names:
+        used = case_params[name]
+        for values in product(*(grid[param] for param in used)):
+            p = defaults._replace(**dict(zip(used, values)))
+            params = {param: getattr(p, param) for param in used}
+            print(f"{name} {params}", end=" ", flush=True)
+            try:
+                metrics = run_case_isolated(name, p, repeat)
+                print(f"{metrics['wall_time_s']:.3f}s {metrics['peak_rss_mb']:.0f}MB")
+            except Exception as e:  # keep going so one failure does not lose the run
+                metrics = {"error": repr(e)}
+                print(f"failed: {e!r}")
+            results.append({"case": name, "params": params, **metrics})
+
+    commit = git_commit()
+    report = {
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "host": platform.node(),
+        "python": platform.python_version(),
+        "cpu_count": multiprocessing.cpu_count(),
+        "results": results,
+    }
+    # outside the repository by default, so a run does not leave the tree dirty
+    results_dir = Path(tempfile.gettempdir()) / "pathgen-benchmarks"
+    path = Path(output) if output else results_dir / f"{commit}.json"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as outfile:
+        json.dump(report, outfile, indent=2)
+    print(f"results written to {path}")
+
+
+@main.command()
+@argument("baseline")
+@argument("candidate")
+@option("--threshold", default=0.1, help="Slow down or memory increase to flag.")
+def compare(baseline, candidate, threshold):
+    """Compare two results files, flagging regressions above the threshold."""
+
+    def load(path: str) -> Dict:
+        with open(path) as f:
+            report = json.load(f)
+        return {
+            (r["case"], json.dumps(r["params"], sort_keys=True)): r
+            for r in report["results"]
+            if "error" not in r
+        }
+
+    old, new = load(baseline), load(candidate)
+    regressions = 0
+    for key in sorted(old.keys() & new.keys()):
+        time_ratio = new[key]["wall_time_s"] / old[key]["wall_time_s"]
+        rss_ratio = new[key]["peak_rss_mb"] / old[key]["peak_rss_mb"]
+        flag = time_ratio > 1 + threshold or rss_ratio > 1 + threshold
+        regressions += flag
+        print(
+            f"{'REGRESSION ' if flag else ''}{key[0]} {key[1]} "
+            f"time x{time_ratio:.2f} rss x{rss_ratio:.2f}"
+        )
+    print(f"{regressions} regressions in {len(old.keys() & new.keys())} cases")
+
+
+if __name__ == "__main__":
+    main()
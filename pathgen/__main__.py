@@ -1,9 +1,21 @@
 #!/usr/bin/python3
 
-from click import group, version_option, command, argument
+from pathlib import Path
+
+from click import group, version_option, command, argument, option
 from multiprocessing import set_start_method
 
 import pathgen.experiments.new as new
+from pathgen.data.datasets.registry import get_dataset
+from pathgen.preprocess.patching import (
+    GridPatchFinder,
+    convert_to_columns,
+    make_index,
+    merge_index,
+    shard_slides,
+)
+from pathgen.preprocess.tissue_detection import TissueDetectorOTSU
+from pathgen.utils.artefact_cache import ArtefactCache
 
 
 @group()
@@ -28,8 +40,77 @@ def show(experiment: str) -> None:
     print(f"{experiment}")
 
 
+@command()
+@argument("dataset")
+@argument("output_dir", type=Path)
+@option("--labels-level", default=5, help="Level to render the labels at.")
+@option("--patch-level", default=0, help="Level to take the patches from.")
+@option("--patch-size", default=256, help="Patch size in pixels at the patch level.")
+@option("--stride", default=0, help="Stride at the patch level, default patch size.")
+@option("--shard", default=0, help="Which shard of the slides to index.")
+@option("--num-shards", default=1, help="The number of shards to split the slides in.")
+@option("--slides", default="", help="Comma separated slide indices, not sharded.")
+@option("--num-workers", default=0, help="Processes to index the slides with.")
+@option("--max-memory", default=0.0, help="Memory limit for each worker in GiB.")
+@option("--cache-dir", type=Path, help="Where to cache labels images and tissue masks.")
+def index(
+    dataset: str,
+    output_dir: Path,
+    labels_level: int,
+    patch_level: int,
+    patch_size: int,
+    stride: int,
+    shard: int,
+    num_shards: int,
+    slides: str,
+    num_workers: int,
+    max_memory: float,
+    cache_dir: Path,
+) -> None:
+    """Index a shard of the slides in DATASET into OUTPUT_DIR."""
+    ds = get_dataset(dataset)
+    if slides:
+        indices = [int(idx) for idx in slides.split(",")]
+    else:
+        indices = shard_slides(ds, shard, num_shards)
+    print(f"indexing {len(indices)} of {len(ds)} slides")
+    make_index(
+        ds,
+        TissueDetectorOTSU(),
+        GridPatchFinder(labels_level, patch_level, patch_size, stride or patch_size),
+        cache=ArtefactCache(cache_dir) if cache_dir else None,
+        num_workers=num_workers,
+        max_memory=int(max_memory * 2 ** 30) or None,
+        output_dir=output_dir,
+        indices=indices,
+    )
+
+
+@command()
+@argument("output_dir", type=Path)
+@argument("shard_dirs", type=Path, nargs=-1, required=True)
+def merge(output_dir: Path, shard_dirs: tuple) -> None:
+    """Merge the slides indexed into SHARD_DIRS into one index in OUTPUT_DIR."""
+    if output_dir in shard_dirs:
+        raise ValueError("The merged index must be saved to a new directory.")
+    slides_index = merge_index(list(shard_dirs))
+    slides_index.save(output_dir)
+    print(f"merged {len(slides_index)} slides into {output_dir}")
+
+
+@command()
+@argument("input_dir", type=Path)
+@argument("output_file", type=Path)
+def convert_index(input_dir: Path, output_file: Path) -> None:
+    """Convert the csv index in INPUT_DIR to a single binary OUTPUT_FILE."""
+    convert_to_columns(input_dir, output_file)
+
+
 main.add_command(run)
 main.add_command(show)
+main.add_command(index)
+main.add_command(merge)
+main.add_command(convert_index)
 
 
 if __name__ == "__main__":
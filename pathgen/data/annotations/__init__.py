@@ -1 +1,2 @@
 from .annotation import *
+from .spatial import *
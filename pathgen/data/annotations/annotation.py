@@ -1,34 +1,56 @@
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple, Union
 
 import cv2
 import numpy as np
 
-from pathgen.utils.geometry import PointF, Shape
+from pathgen.utils.geometry import Point, PointF, Shape
 
 annotation_types = ["Dot", "Polygon", "Spline", "Rectangle"]
 
 
 class Annotation:
     def __init__(
-        self, name: str, annotation_type: str, label: str, vertices: List[PointF]
+        self,
+        name: str,
+        annotation_type: str,
+        label: str,
+        vertices: Union[List[PointF], np.ndarray],
     ):
         assert annotation_type in annotation_types
         self.name = name
         self.type = annotation_type
         self.label = label
         self.coordinates = vertices
+        self._bounds = None
+
+    @property
+    def bounds(self) -> Optional[Tuple[float, float, float, float]]:
+        """The left, top, right and bottom of the vertices, or None if there are none."""
+        if self._bounds is None and len(self.coordinates) > 0:
+            vertices = np.asarray(self.coordinates)
+            left, top = vertices.min(axis=0)
+            right, bottom = vertices.max(axis=0)
+            self._bounds = (float(left), float(top), float(right), float(bottom))
+        return self._bounds
 
-    def draw(self, image: np.array, labels: Dict[str, int], factor: float):
+    def draw(
+        self,
+        image: np.array,
+        labels: Dict[str, int],
+        factor: float,
+        origin: Point = Point(0, 0),
+    ):
         """Renders the annotation into the image.
 
         Args:
-            image (np.array): Array to write the annotations into, must have dtype float.
+            image (np.array): Array to write the annotations into, must have a dtype cv2 can draw into.
             labels (Dict[str, int]): The value to write into the image for each type of label.
             factor (float): How much to scale (by divison) each vertex by.
+            origin (Point, optional): Where the image starts, after scaling. Defaults to (0, 0).
         """
         fill_colour = labels[self.label]
         vertices = np.array(self.coordinates) / factor
-        vertices = vertices.astype(np.int32)
+        vertices = vertices.astype(np.int32) - np.array(origin, dtype=np.int32)
         cv2.fillPoly(image, [vertices], (fill_colour))
 
 
@@ -45,11 +67,90 @@ class AnnotationSet:
         self.labels_order = labels_order
         self.fill_label = fill_label
 
-    def render(self, shape: Shape, factor: float) -> np.array:
-        annotations = sorted(
-            self.annotations, key=lambda a: self.labels_order.index(a.label)
-        )
-        image = np.full(shape, self.labels[self.fill_label], dtype=float)
-        for a in annotations:
-            a.draw(image, self.labels, factor)
-        return image.astype("int")
+    def render(
+        self, shape: Shape, factor: float, dtype=int, tile_size: int = None
+    ) -> np.array:
+        """ Render the annotations into a labels image.
+
+        Args:
+            shape (Shape): The shape of the labels image.
+            factor (float): How much to scale (by divison) each vertex by.
+            dtype (optional): The dtype of the labels image. uint8 uses an eighth of
+                the memory of the default int. Defaults to int.
+            tile_size (int, optional): Render the image in tiles of this size, so the
+                working memory is bounded by the tile rather than the image. OpenCV
+                clips a polygon edge that leaves the image it draws into to whole
+                pixel end points, so an edge that crosses a tile is drawn with a
+                slightly different slope along its whole length inside the tile and
+                its pixels can be a pixel off from rendering the whole image.
+                Defaults to None, which renders the whole image at once.
+
+        Returns:
+            np.array: The labels image.
+        """
+        image = np.empty(shape, dtype=dtype)
+        num_rows, num_cols = shape
+        tile_rows = tile_size or num_rows
+        tile_cols = tile_size or num_cols
+        for top in range(0, num_rows, tile_rows):
+            for left in range(0, num_cols, tile_cols):
+                window = Shape(
+                    min(tile_rows, num_rows - top), min(tile_cols, num_cols - left)
+                )
+                out = image[top : top + window.num_rows, left : left + window.num_cols]
+                self.render_window(Point(left, top), window, factor, out=out)
+        return image
+
+    def render_window(
+        self,
+        origin: Point,
+        shape: Shape,
+        factor: float,
+        dtype=np.uint8,
+        out: np.array = None,
+        annotations: List[Annotation] = None,
+    ) -> np.array:
+        """ Render part of the labels image, skipping annotations that are outside it.
+
+        Args:
+            origin (Point): The location of the top left of the window in the labels image.
+            shape (Shape): The shape of the window.
+            factor (float): How much to scale (by divison) each vertex by.
+            dtype (optional): The dtype of the returned window if out is not given.
+                Defaults to np.uint8.
+            out (np.array, optional): An array to render the window into. Defaults to None.
+            annotations (List[Annotation], optional): Only draw these annotations, for
+                example the candidates from an AnnotationIndex. Defaults to None, which
+                draws all of them.
+
+        Returns:
+            np.array: The window of the labels image.
+        """
+        if annotations is None:
+            annotations = self.annotations
+        if out is None:
+            out = np.empty(shape, dtype=dtype)
+
+        # cv2 can draw polygon edges that cross the edge of the image into the first or
+        # last row or column, so draw with a margin around the window and crop it
+        margin = 2
+        left, top = origin
+        num_rows, num_cols = shape
+        image = np.empty((num_rows + 2 * margin, num_cols + 2 * margin), np.int32)
+        image.fill(self.labels[self.fill_label])
+
+        right, bottom = left + num_cols + margin, top + num_rows + margin
+        order = self.labels_order.index
+        for a in sorted(annotations, key=lambda a: order(a.label)):
+            bounds = a.bounds
+            if bounds is None:
+                continue
+            a_left, a_top, a_right, a_bottom = (int(b / factor) for b in bounds)
+            if a_right < left - margin or a_left >= right:
+                continue
+            if a_bottom < top - margin or a_top >= bottom:
+                continue
+            a.draw(image, self.labels, factor, Point(left - margin, top - margin))
+
+        out[:] = image[margin : margin + num_rows, margin : margin + num_cols]
+        return out
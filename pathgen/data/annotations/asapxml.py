@@ -1,46 +1,165 @@
+import os
+from array import array
 from pathlib import Path
-from typing import List, Dict
+from typing import Iterator, List, Dict, NamedTuple, Optional
 import xml.etree.ElementTree as ET
 
+import numpy as np
+
 from pathgen.data.annotations.annotation import Annotation
+from pathgen.utils.columnar import read_columns, write_columns
+from pathgen.utils.paths import file_fingerprint
+
+CACHE_SUFFIX = ".annotations"
+
+
+class AnnotationRecord(NamedTuple):
+    name: str
+    type: str
+    group: str
+    vertices: np.ndarray  # float32 array of shape (num_vertices, 2)
+
+
+def iter_annotation_records(xml_file_path: Path) -> Iterator[AnnotationRecord]:
+    """ Stream the annotations out of an ASAP xml file without building the whole tree.
+
+    Each annotation's element is cleared once it has been read, so the memory used
+    is the vertices, which are kept as contiguous float32 arrays.
+    """
+    vertices = array("f")
+    for _, elem in ET.iterparse(str(xml_file_path), events=("end",)):
+        if elem.tag == "Coordinate":
+            vertices.append(float(elem.attrib["X"]))
+            vertices.append(float(elem.attrib["Y"]))
+        elif elem.tag == "Annotation":
+            yield AnnotationRecord(
+                elem.attrib["Name"],
+                elem.attrib["Type"],
+                elem.attrib["PartOfGroup"],
+                np.frombuffer(vertices, dtype=np.float32).reshape(-1, 2),
+            )
+            vertices = array("f")
+            elem.clear()
+
 
+def cache_path(xml_file_path: Path) -> Path:
+    return xml_file_path.with_name(xml_file_path.name + CACHE_SUFFIX)
 
-def annotation_from_tag(tag: ET.Element, group_labels: Dict[str, str]) -> Annotation:
-    # get the attributes
-    name = tag.attrib["Name"]
-    group = tag.attrib["PartOfGroup"]
-    annotation_tag = tag.attrib["Type"]
-    coordinate_tags = tag.find("Coordinates")
 
-    # groups Tumor, _0 and _1 are tumor annoations and group _2 are normal annoations
-    # assert group in ["Tumor", "_0", "_1", "_2"], "Unknown annoation group encountered."
-    # label = "tumor" if group in ["Tumor", "_0", "_1"] else "normal"
-    assert group in group_labels.keys(), f"Unknown annoation group encountered. {group}"
-    label = group_labels[group]
+def read_annotations_cache(xml_file_path: Path) -> Optional[List[AnnotationRecord]]:
+    """Read the cached records for the xml file, or None if they are missing or out of date."""
+    path = cache_path(xml_file_path)
+    if not path.is_file():
+        return None
+    try:
+        columns, attrs = read_columns(path, mmap=True)
+    except (OSError, ValueError, KeyError):
+        return None
+    if attrs.get("source") != file_fingerprint(xml_file_path):
+        return None
+    vertices, offsets = columns["vertices"], columns["offsets"]
+    return [
+        AnnotationRecord(name, type_, group, vertices[start:stop])
+        for name, type_, group, start, stop in zip(
+            attrs["names"], attrs["types"], attrs["groups"], offsets[:-1], offsets[1:]
+        )
+    ]
 
-    # parse the coordinate to a list of lists with two floats
-    vertices = [(float(c.attrib["X"]), float(c.attrib["Y"])) for c in coordinate_tags]
 
-    # pass the data to the annotation factory
-    return Annotation(name, annotation_tag, label, vertices)
+def write_annotations_cache(
+    xml_file_path: Path, records: List[AnnotationRecord]
+) -> None:
+    """ Cache the records next to the xml file as one file of all the vertices.
+
+    The cache is written to a temporary file and moved into place, so readers never
+    see a partial file. If the directory is not writable no cache is written.
+    """
+    lengths = [len(r.vertices) for r in records]
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    vertices = [r.vertices for r in records] or [np.empty((0, 2), np.float32)]
+    columns = {
+        "vertices": np.concatenate(vertices).astype(np.float32),
+        "offsets": offsets,
+    }
+    attrs = {
+        "source": file_fingerprint(xml_file_path),
+        "names": [r.name for r in records],
+        "types": [r.type for r in records],
+        "groups": [r.group for r in records],
+    }
+    path = cache_path(xml_file_path)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    try:
+        write_columns(tmp_path, columns, attrs)
+        os.replace(tmp_path, path)
+    except OSError:
+        if tmp_path.exists():
+            tmp_path.unlink()
 
 
 def load_annotations(
-    xml_file_path: Path, group_labels: Dict[str, str]
+    xml_file_path: Path, group_labels: Dict[str, str], cache: bool = False
 ) -> List[Annotation]:
+    """ Load the annotations from an ASAP xml file.
+
+    Args:
+        xml_file_path (Path): The xml file. If it is not a file no annotations are returned.
+        group_labels (Dict[str, str]): The label for the annotations in each ASAP group.
+        cache (bool, optional): Keep a binary copy of the vertices next to the xml file,
+            which is memory mapped on later loads until the xml file changes.
+            Defaults to False.
+
+    Returns:
+        List[Annotation]: The annotations, with their vertices as float32 arrays.
+    """
     # if the path is empty or a dir then return an empty annotations list
     # TODO: Make sure this requirement is stated in the requirements for
     # load_annotations functions
     if not xml_file_path.is_file():
         return []
 
-    # find all the annotation tags in the xml document
-    tree = ET.parse(xml_file_path)
-    root = tree.getroot()
-    tags = root.find("Annotations")
-
-    # get the type and colour properties and coordinated for each annotation
-    annotations = [annotation_from_tag(tag, group_labels) for tag in tags]
-    annotations = [a for a in annotations if a]  # remove None values
+    records = read_annotations_cache(xml_file_path) if cache else None
+    if records is None:
+        records = list(iter_annotation_records(xml_file_path))
+        if cache:
+            write_annotations_cache(xml_file_path, records)
 
+    annotations = []
+    for r in records:
+        message = f"Unknown annoation group encountered. {r.group}"
+        assert r.group in group_labels, message
+        label = group_labels[r.group]
+        annotations.append(Annotation(r.name, r.type, label, r.vertices))
     return annotations
+
+
+def save_annotations(
+    annotations: List[Annotation], xml_file_path: Path, label_groups: Dict[str, str]
+) -> None:
+    """ Write annotations to an ASAP xml file that load_annotations can read.
+
+    Args:
+        annotations (List[Annotation]): The annotations to write.
+        xml_file_path (Path): The file to write.
+        label_groups (Dict[str, str]): The ASAP group to put the annotations with each label in.
+    """
+    root = ET.Element("ASAP_Annotations")
+    tags = ET.SubElement(root, "Annotations")
+    for annotation in annotations:
+        tag = ET.SubElement(
+            tags,
+            "Annotation",
+            Name=annotation.name,
+            Type=annotation.type,
+            PartOfGroup=label_groups[annotation.label],
+            Color="#F4FA58",
+        )
+        coordinate_tags = ET.SubElement(tag, "Coordinates")
+        for order, (x, y) in enumerate(annotation.coordinates):
+            ET.SubElement(
+                coordinate_tags, "Coordinate", Order=str(order), X=str(x), Y=str(y)
+            )
+    groups = ET.SubElement(root, "AnnotationGroups")
+    for group in sorted(set(label_groups.values())):
+        ET.SubElement(groups, "Group", Name=group, PartOfGroup="None", Color="#64FE2E")
+    ET.ElementTree(root).write(xml_file_path)
@@ -0,0 +1,155 @@
+from typing import Sequence, Tuple
+
+import numpy as np
+
+from pathgen.data.annotations.annotation import AnnotationSet
+from pathgen.data.slides.region import Region
+from pathgen.utils.geometry import Point, Shape
+
+
+def _expand(starts: np.ndarray, stops: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # the item index and value of every value in the half open range of each item
+    counts = np.maximum(stops - starts, 0)
+    items = np.repeat(np.arange(len(starts)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return items, starts[items] + offsets
+
+
+class AnnotationIndex:
+    def __init__(self, annotation_set: AnnotationSet, cell_size: int = 4096) -> None:
+        """ A uniform grid of buckets over the bounding boxes of a set of annotations.
+
+        The index answers which annotations intersect a batch of regions, and what
+        fraction of each region has each label, without rendering the whole slide.
+        Each annotation is put in every cell of the grid that its bounding box
+        touches, so a query only looks at the annotations in the cells that the
+        regions touch.
+
+        Args:
+            annotation_set (AnnotationSet): The annotations to index.
+            cell_size (int, optional): The width and height of the cells at level 0.
+                Defaults to 4096.
+        """
+        self.annotation_set = annotation_set
+        self.cell_size = cell_size
+        self.annotations = [a for a in annotation_set.annotations if a.bounds]
+        self.bounds = np.array(
+            [a.bounds for a in self.annotations], dtype=np.float64
+        ).reshape(-1, 4)
+
+        # the cells each annotation touches, as sorted keys into a flattened grid
+        cells = np.floor(self.bounds / cell_size).astype(np.int64)
+        self._num_cols = int(cells[:, 2].max()) + 1 if len(cells) else 0
+        self._num_rows = int(cells[:, 3].max()) + 1 if len(cells) else 0
+        items, keys = self._cell_keys(cells)
+        order = np.argsort(keys, kind="stable")
+        self._keys = keys[order]
+        self._items = items[order]
+
+    def __len__(self) -> int:
+        return len(self.annotations)
+
+    def _cell_keys(self, cells: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # cells is the left, top, right, bottom cell of each box, inclusive
+        cells = cells.copy()
+        cells[:, [0, 2]] = np.clip(cells[:, [0, 2]], 0, self._num_cols - 1)
+        cells[:, [1, 3]] = np.clip(cells[:, [1, 3]], 0, self._num_rows - 1)
+        num_cols = cells[:, 2] - cells[:, 0] + 1
+        num_rows = cells[:, 3] - cells[:, 1] + 1
+        items, offsets = _expand(np.zeros(len(cells), np.int64), num_cols * num_rows)
+        cols = cells[items, 0] + offsets % num_cols[items]
+        rows = cells[items, 1] + offsets // num_cols[items]
+        return items, rows * self._num_cols + cols
+
+    def query(self, boxes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """ Find the annotations whose bounding boxes intersect each box.
+
+        Args:
+            boxes (np.ndarray): An N x 4 array of the left, top, right and bottom of each
+                box at level 0.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: The box and annotation indices of each
+                intersecting pair, sorted by box.
+        """
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        if len(boxes) == 0 or len(self.annotations) == 0:
+            return np.empty(0, np.int64), np.empty(0, np.int64)
+
+        # drop boxes that are outside the grid, then look up the cells they touch
+        cells = np.floor(boxes / self.cell_size).astype(np.int64)
+        inside = (cells[:, 2] >= 0) & (cells[:, 0] < self._num_cols)
+        inside &= (cells[:, 3] >= 0) & (cells[:, 1] < self._num_rows)
+        box_indices = np.flatnonzero(inside)
+        items, keys = self._cell_keys(cells[box_indices])
+        starts = np.searchsorted(self._keys, keys, side="left")
+        stops = np.searchsorted(self._keys, keys, side="right")
+        pairs, positions = _expand(starts, stops)
+        box_idx = box_indices[items[pairs]]
+        annotation_idx = self._items[positions]
+
+        # an annotation can be in several of the cells a box touches
+        pair_keys = np.unique(box_idx * len(self.annotations) + annotation_idx)
+        box_idx = pair_keys // len(self.annotations)
+        annotation_idx = pair_keys % len(self.annotations)
+
+        a, b = self.bounds[annotation_idx], boxes[box_idx]
+        overlaps = (a[:, 0] <= b[:, 2]) & (a[:, 2] >= b[:, 0])
+        overlaps &= (a[:, 1] <= b[:, 3]) & (a[:, 3] >= b[:, 1])
+        return box_idx[overlaps], annotation_idx[overlaps]
+
+    def area_fractions(self, regions: Sequence[Region]) -> np.ndarray:
+        """ The fraction of each region covered by each label.
+
+        The regions are rendered at their own level, so the result is approximately
+        equal to rendering the whole slide at that level and counting the labels in
+        the region (boundary pixels may differ, as a polygon edge can be rasterised a
+        pixel differently in a small window). Only the annotations that intersect a
+        region are drawn.
+
+        Args:
+            regions (Sequence[Region]): The regions, with locations at level 0.
+
+        Returns:
+            np.ndarray: An N x num labels array, where column j is the fraction of the
+                region with the label whose value is j.
+        """
+        labels = self.annotation_set.labels
+        num_labels = max(labels.values()) + 1
+        fractions = np.zeros((len(regions), num_labels))
+        fractions[:, labels[self.annotation_set.fill_label]] = 1
+        if len(regions) == 0:
+            return fractions
+
+        boxes = np.empty((len(regions), 4), dtype=np.float64)
+        for idx, region in enumerate(regions):
+            x, y = region.location
+            width, height = region.size
+            factor = 2 ** region.level
+            # pad by a pixel at the region level, as vertices are truncated when drawn
+            boxes[idx] = (
+                x - factor,
+                y - factor,
+                x + (width + 1) * factor,
+                y + (height + 1) * factor,
+            )
+
+        box_idx, annotation_idx = self.query(boxes)
+        starts = np.flatnonzero(np.diff(box_idx, prepend=-1))
+        for idx, candidates in zip(
+            box_idx[starts], np.split(annotation_idx, starts[1:])
+        ):
+            region = regions[idx]
+            x, y = region.location
+            width, height = region.size
+            factor = 2 ** region.level
+            window = self.annotation_set.render_window(
+                Point(int(x // factor), int(y // factor)),
+                Shape(height, width),
+                factor,
+                dtype=np.int32,
+                annotations=[self.annotations[c] for c in candidates],
+            )
+            counts = np.bincount(window.ravel(), minlength=num_labels)
+            fractions[idx] = counts / window.size
+        return fractions
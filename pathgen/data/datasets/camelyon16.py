@@ -25,7 +25,7 @@ class Camelyon16(Dataset):
             "Exclusion": "normal",
             "None": "normal",
         }
-        annotations = load_annotations(file, group_labels) if file else []
+        annotations = load_annotations(file, group_labels, cache=True) if file else []
         labels_order = ["background", "tumor", "normal"]
         return AnnotationSet(annotations, self.labels, labels_order, "normal")
 
@@ -1,10 +1,11 @@
 from abc import ABCMeta, abstractmethod
 from collections import Sequence
 from pathlib import Path
-from typing import Dict
+from typing import ContextManager, Dict
 
 import pandas as pd
 
+from pathgen.data.slides.pool import get_slide_pool
 from pathgen.data.slides.slide import SlideBase
 from pathgen.data.annotations.annotation import AnnotationSet
 from pathgen.utils.paths import project_root
@@ -78,6 +79,10 @@ class Dataset(Sequence, metaclass=ABCMeta):
         slide_path = self.to_abs_path(row["slide"])
         return self.slide_cls(slide_path)
 
+    def borrow_slide(self, idx: int) -> ContextManager[SlideBase]:
+        """Use an open slide from the process wide slide pool, rather than opening a new one."""
+        return get_slide_pool().borrow(self.get_slide_path(idx), self.slide_cls)
+
     def get_slide_path(self, idx: int):
         row = self.paths.iloc[idx]
         slide_path = self.to_abs_path(row["slide"])
@@ -1,4 +1,4 @@
-from pathgen.data.datasets import Dataset, camelyon16
+from pathgen.data.datasets import Dataset, camelyon16, synthetic
 
 datasets = {}
 
@@ -12,3 +12,8 @@ def get_dataset(name: str) -> Dataset:
         dataset = constructor()
         datasets[name] = dataset
         return dataset
+
+
+def register_dataset(dataset: Dataset) -> None:
+    """Make a data set that has no constructor in this module available to get_dataset."""
+    datasets[dataset.name] = dataset
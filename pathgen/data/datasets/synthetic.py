@@ -0,0 +1,123 @@
+from functools import partial
+from pathlib import Path
+from typing import Any, Dict
+
+import pandas as pd
+
+from pathgen.data.annotations import Annotation, AnnotationSet
+from pathgen.data.annotations.asapxml import load_annotations, save_annotations
+from pathgen.data.datasets import Dataset
+from pathgen.data.slides import SlideBase
+from pathgen.data.slides.synthetic import SyntheticLayout, SyntheticSlide
+from pathgen.utils.geometry import Size
+from pathgen.utils.paths import project_root
+
+group_labels = {"Tumor": "tumor", "Exclusion": "normal", "None": "normal"}
+label_groups = {"tumor": "Tumor", "normal": "Exclusion"}
+
+
+class SyntheticDataset(Dataset):
+    """ A data set of procedurally generated slides, see SyntheticSlide.
+
+    The slides and annotations do not need to exist on disk. The tumour annotations
+    are generated from the same layout as the slide with the same name, unless
+    write_annotations has been called, in which case they are read from the ASAP
+    xml files like a real data set.
+
+    Args:
+        name (str): The name of the data set.
+        root (Path): The directory the slide and annotation paths are relative to.
+        paths (pd.DataFrame): The slide, annotation, label and tags for each slide.
+        slide_args (Dict[str, Any]): Arguments passed to SyntheticSlide for every slide.
+    """
+
+    def __init__(
+        self, name: str, root: Path, paths: pd.DataFrame, slide_args: Dict[str, Any]
+    ) -> None:
+        super().__init__(name, root, paths)
+        self.slide_args = slide_args
+
+    def load_annotations(self, file: Path) -> AnnotationSet:
+        labels_order = ["background", "tumor", "normal"]
+        annotations = []
+        if file and Path(file).is_file():
+            annotations = load_annotations(Path(file), group_labels)
+        elif file:
+            size = self.slide_args.get("size", Size(32768, 24576))
+            layout = SyntheticLayout.generate(
+                Path(file).stem,
+                Size(*size),
+                self.slide_args.get("num_blobs", 4),
+                self.slide_args.get("num_tumours", 2),
+            )
+            annotations = [
+                Annotation(f"Annotation {idx}", "Polygon", "tumor", tumour.polygon())
+                for idx, tumour in enumerate(layout.tumours)
+            ]
+        return AnnotationSet(annotations, self.labels, labels_order, "normal")
+
+    @property
+    def slide_cls(self) -> SlideBase:
+        tumour_slides = self.paths["slide"][self.paths["label"] == "tumor"]
+        tumour_slides = frozenset(Path(p).stem for p in tumour_slides)
+        return partial(make_slide, tumour_slides=tumour_slides, **self.slide_args)
+
+    @property
+    def labels(self) -> Dict[str, int]:
+        return {"background": 0, "normal": 1, "tumor": 2}
+
+    def write_annotations(self) -> None:
+        """Write the generated annotations for each tumour slide as an ASAP xml file."""
+        for idx in range(len(self)):
+            _, annotation_path, _, _ = self[idx]
+            if annotation_path:
+                annotations = self.load_annotations(annotation_path).annotations
+                annotation_path.parent.mkdir(parents=True, exist_ok=True)
+                save_annotations(annotations, annotation_path, label_groups)
+
+
+def make_slide(path: Path, tumour_slides: frozenset, **slide_args) -> SyntheticSlide:
+    # normal slides are generated without any tumours
+    if Path(path).stem not in tumour_slides:
+        slide_args["num_tumours"] = 0
+    return SyntheticSlide(path, **slide_args)
+
+
+def make_synthetic(
+    name: str, num_tumour: int, num_normal: int, **slide_args
+) -> SyntheticDataset:
+    root = project_root() / "data" / "synthetic" / name
+    tumour_names = [f"tumor_{idx:03d}" for idx in range(1, num_tumour + 1)]
+    normal_names = [f"normal_{idx:03d}" for idx in range(1, num_normal + 1)]
+
+    df = pd.DataFrame()
+    df["slide"] = [Path("tumor") / f"{n}.tif" for n in tumour_names] + [
+        Path("normal") / f"{n}.tif" for n in normal_names
+    ]
+    df["annotation"] = [
+        Path("lesion_annotations") / f"{n}.xml" for n in tumour_names
+    ] + ["" for _ in normal_names]
+    df["label"] = ["tumor"] * num_tumour + ["normal"] * num_normal
+    df["tags"] = ""
+
+    return SyntheticDataset(f"synthetic.{name}", root, df, slide_args)
+
+
+def small():
+    return make_synthetic("small", 2, 2, size=Size(8192, 6144), num_levels=5)
+
+
+def medium():
+    return make_synthetic("medium", 8, 8, size=Size(32768, 24576), num_levels=7)
+
+
+def large():
+    # roughly the size of a camelyon16 slide, with a realistic decode cost
+    return make_synthetic(
+        "large",
+        8,
+        8,
+        size=Size(98304, 196608),
+        num_levels=9,
+        decode_cost=0.0005,
+    )
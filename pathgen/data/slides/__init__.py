@@ -1,2 +1,5 @@
 from .slide import *
 from .region import *
+from .cache import *
+from .pool import *
+from .planner import *
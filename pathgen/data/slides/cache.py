@@ -0,0 +1,162 @@
+from collections import OrderedDict
+from pathlib import Path
+from threading import Lock
+from typing import Hashable, List, Optional
+
+import numpy as np
+from PIL import Image
+
+from pathgen.data.slides.region import Region
+from pathgen.data.slides.slide import SlideBase, check_region_buffer
+from pathgen.utils.geometry import Point, Size
+
+
+class TileCache:
+    def __init__(self, max_bytes: int = 512 * 2 ** 20) -> None:
+        """ A thread safe least recently used cache of decoded tiles with a memory budget.
+
+        Args:
+            max_bytes (int, optional): The total size of the cached arrays above which the
+                least recently used tiles are evicted. Defaults to 512 MiB.
+        """
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._tiles = OrderedDict()
+        self._num_bytes = 0
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._tiles)
+
+    @property
+    def num_bytes(self) -> int:
+        return self._num_bytes
+
+    def get(self, key: Hashable) -> Optional[np.ndarray]:
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is None:
+                self.misses += 1
+                return None
+            self._tiles.move_to_end(key)
+            self.hits += 1
+            return tile
+
+    def put(self, key: Hashable, tile: np.ndarray) -> None:
+        # tiles bigger than the whole budget are never cached
+        if tile.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._tiles:
+                self._num_bytes -= self._tiles.pop(key).nbytes
+            self._tiles[key] = tile
+            self._num_bytes += tile.nbytes
+            while self._num_bytes > self.max_bytes:
+                _, evicted = self._tiles.popitem(last=False)
+                self._num_bytes -= evicted.nbytes
+
+    def clear(self) -> None:
+        with self._lock:
+            self._tiles.clear()
+            self._num_bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+
+class CachedSlide(SlideBase):
+    def __init__(
+        self, slide: SlideBase, cache: TileCache = None, tile_size: int = 512
+    ) -> None:
+        """ Wraps a slide so that regions are assembled from cached, decoded tiles.
+
+        Each level is split into a grid of tile_size tiles. When a region is read the
+        tiles that it overlaps are taken from the cache, or read from the wrapped slide
+        and added to the cache, and the region is copied out of them. Overlapping and
+        neighbouring regions then only decode the pixels they share once.
+
+        Args:
+            slide (SlideBase): The slide to read the tiles from.
+            cache (TileCache, optional): The cache to store the tiles in. It can be shared
+                between slides. Defaults to a new cache with the default budget.
+            tile_size (int, optional): The width and height of the cached tiles. Ideally
+                this matches the tile size of the slide file. Defaults to 512.
+        """
+        self._slide = slide
+        self.cache = cache if cache is not None else TileCache()
+        self.tile_size = tile_size
+
+    def open(self) -> None:
+        self._slide.open()
+
+    def close(self) -> None:
+        self._slide.close()
+
+    @property
+    def path(self) -> Path:
+        return self._slide.path
+
+    @property
+    def dimensions(self) -> List[Size]:
+        return self._slide.dimensions
+
+    @property
+    def level_downsamples(self) -> List[float]:
+        return self._slide.level_downsamples
+
+    def read_region(self, region: Region) -> Image:
+        width, height = region.size
+        image = np.zeros((height, width, 4), dtype=np.uint8)
+        self._assemble(region, image)
+        return Image.fromarray(image, "RGBA")
+
+    def read_regions(self, regions: List[Region]) -> Image:
+        return [self.read_region(region) for region in regions]
+
+    def read_region_into(self, region: Region, out: np.ndarray) -> np.ndarray:
+        check_region_buffer(region, out)
+        self._assemble(region, out)
+        return out
+
+    def _read_tile(self, level: int, col: int, row: int) -> np.ndarray:
+        key = (str(self.path), level, col, row)
+        tile = self.cache.get(key)
+        if tile is None:
+            downsample = self.level_downsamples[level]
+            location = Point(
+                int(round(col * self.tile_size * downsample)),
+                int(round(row * self.tile_size * downsample)),
+            )
+            size = Size(self.tile_size, self.tile_size)
+            tile = np.asarray(self._slide.read_region(Region(level, location, size)))
+            self.cache.put(key, tile)
+        return tile
+
+    def _assemble(self, region: Region, out: np.ndarray) -> None:
+        # the location is in level 0 coordinates and the size at the region's level
+        x, y = region.location
+        width, height = region.size
+        downsample = self.level_downsamples[region.level]
+        left, top = int(x // downsample), int(y // downsample)
+        right, bottom = left + width, top + height
+
+        # only the part of the region inside the level is read, the rest is zero
+        level_size = self.dimensions[region.level]
+        x_start, x_end = max(left, 0), min(right, level_size.width)
+        y_start, y_end = max(top, 0), min(bottom, level_size.height)
+        if (x_start, y_start, x_end, y_end) != (left, top, right, bottom):
+            out.fill(0)
+        if x_start >= x_end or y_start >= y_end:
+            return
+
+        ts = self.tile_size
+        channels = out.shape[2]
+        for row in range(y_start // ts, (y_end - 1) // ts + 1):
+            for col in range(x_start // ts, (x_end - 1) // ts + 1):
+                tile = self._read_tile(region.level, col, row)
+                tx0, ty0 = col * ts, row * ts
+                x0, x1 = max(x_start, tx0), min(x_end, tx0 + ts)
+                y0, y1 = max(y_start, ty0), min(y_end, ty0 + ts)
+                out[y0 - top : y1 - top, x0 - left : x1 - left] = tile[
+                    y0 - ty0 : y1 - ty0, x0 - tx0 : x1 - tx0, :channels
+                ]
@@ -1,22 +1,42 @@
+from concurrent.futures import ThreadPoolExecutor
+from ctypes import POINTER, c_uint32
 from pathlib import Path
+from threading import Lock, local
 from typing import List
 
+import numpy as np
 from PIL import Image
-from openslide import open_slide
+from openslide import lowlevel, open_slide
 
-from pathgen.data.slides.slide import SlideBase, Region
+from pathgen.data.slides.slide import SlideBase, Region, check_region_buffer
+from pathgen.utils.concurrency import bounded_map
 from pathgen.utils.geometry import Size
 
 
 class Slide(SlideBase):
-    def __init__(self, path: Path) -> None:
+    def __init__(self, path: Path, num_workers: int = 1) -> None:
+        """ A slide read with OpenSlide.
+
+        Args:
+            path (Path): The path to the slide file.
+            num_workers (int, optional): The number of threads used by read_regions.
+                OpenSlide releases the GIL while decoding so reads run concurrently.
+                Defaults to 1 which reads the regions serially.
+        """
         self._path = path
         self._osr = None
+        self._num_workers = num_workers
+        self._executor = None
+        self._executor_lock = Lock()
+        self._buffers = local()
 
     def open(self) -> None:
         self._osr = open_slide(str(self._path))
 
     def close(self) -> None:
+        if self._executor:
+            self._executor.shutdown(wait=True)
+            self._executor = None
         self._osr.close()
 
     @property
@@ -28,11 +48,127 @@ class Slide(SlideBase):
         # TODO: how should these be clipped? so they are power of 2 scale factor compatable
         return [Size(*dim) for dim in self._osr.level_dimensions]
 
+    @property
+    def level_downsamples(self) -> List[float]:
+        return list(self._osr.level_downsamples)
+
     def read_region(self, region: Region) -> Image:
         return self._osr.read_region(region.location, region.level, region.size)
 
-    def read_regions(self, regions: List[Region]) -> Image:
-        # TODO: this call could be parallelised
-        # though pytorch loaders will do this for us
-        regions = [self.read_region(region) for region in regions]
-        return regions
+    def read_region_into(self, region: Region, out: np.ndarray) -> np.ndarray:
+        """ Read a region as RGB pixels directly into an existing array.
+
+        This decodes straight into a reused buffer with openslide-python's private
+        lowlevel._read_region and OpenSlide._osr handle. If either is missing, for
+        example in another openslide-python version or for an image that is not a
+        whole slide image, it falls back to read_region and np.asarray.
+
+        Args:
+            region (Region): The region to read.
+            out (np.ndarray): A uint8 array of shape (height, width, 3) to write to.
+
+        Returns:
+            np.ndarray: The out array.
+        """
+        check_region_buffer(region, out)
+        handle = getattr(self._osr, "_osr", None)
+        read_argb = getattr(lowlevel, "_read_region", None)
+        if handle is None or read_argb is None:
+            # not a whole slide image (or an old openslide), read it through PIL
+            return super().read_region_into(region, out)
+
+        # openslide writes premultiplied ARGB into a per thread scratch buffer
+        # that is reused between calls, so only the copy into out touches new memory
+        height, width = out.shape[:2]
+        argb = self._argb_buffer(width * height)
+        x, y = region.location
+        read_argb(
+            handle,
+            argb.ctypes.data_as(POINTER(c_uint32)),
+            int(x),
+            int(y),
+            region.level,
+            width,
+            height,
+        )
+
+        # as little endian bytes each pixel is B, G, R, A
+        bgra = argb.view(np.uint8).reshape(height, width, 4)
+        np.copyto(out, bgra[:, :, 2::-1])
+        if bgra[:, :, 3].min() < 255:
+            # undo the premultiplication for partially transparent edge pixels
+            alpha = bgra[:, :, 3:].astype(np.uint16)
+            partial = (alpha > 0) & (alpha < 255)
+            # in uint16, as numpy 1.x would keep out * 255 in uint8 and overflow
+            unmultiplied = out.astype(np.uint16) * 255 // np.maximum(alpha, 1)
+            unmultiplied = np.minimum(unmultiplied, 255).astype(np.uint8)
+            np.copyto(out, unmultiplied, where=partial)
+        return out
+
+    def _argb_buffer(self, num_pixels: int) -> np.ndarray:
+        buffer = getattr(self._buffers, "argb", None)
+        if buffer is None or buffer.size < num_pixels:
+            buffer = np.empty(num_pixels, dtype=np.uint32)
+            self._buffers.argb = buffer
+        return buffer[:num_pixels]
+
+    def read_regions(
+        self,
+        regions: List[Region],
+        max_workers: int = None,
+        coalesce: bool = False,
+        max_read_size: int = 2048,
+        max_waste: float = 0.25,
+    ) -> Image:
+        """ Read a batch of regions, concurrently if the slide has more than one worker.
+
+        Args:
+            regions (List[Region]): The regions to read.
+            max_workers (int, optional): Limit the number of concurrent reads for this
+                call. Can not exceed the slide's num_workers. Defaults to num_workers.
+            coalesce (bool, optional): Read the regions with read_regions_coalesced,
+                which groups nearby regions into larger reads and returns each region
+                as an RGB uint8 array sliced out of them. Defaults to False.
+            max_read_size (int, optional): The largest width or height of a grouped
+                read. Only used if coalesce is True. Defaults to 2048.
+            max_waste (float, optional): The largest fraction of a grouped read that is
+                not in any region. Only used if coalesce is True. Defaults to 0.25.
+
+        Returns:
+            List[Image]: The images for each region, in the same order as regions, or
+                the arrays if coalesce is True.
+        """
+        if not coalesce:
+            return self._map(self.read_region, regions, max_workers)
+
+        return self.read_regions_coalesced(
+            regions, max_read_size, max_waste, max_workers
+        )
+
+    def _read_blocks(
+        self, regions: List[Region], max_workers: int = None
+    ) -> List[np.ndarray]:
+        def read_block(region: Region) -> np.ndarray:
+            width, height = region.size
+            block = np.empty((height, width, 3), dtype=np.uint8)
+            return self.read_region_into(region, block)
+
+        return self._map(read_block, regions, max_workers)
+
+    def _map(self, fn, regions: List[Region], max_workers: int = None) -> List:
+        num_workers = self._num_workers
+        if max_workers is not None:
+            num_workers = min(num_workers, max_workers)
+        if num_workers <= 1 or len(regions) <= 1:
+            return [fn(region) for region in regions]
+        return bounded_map(self._get_executor(), fn, regions, num_workers)
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        # created on first use so slides that are only read serially start no threads
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self._num_workers,
+                    thread_name_prefix=f"read-{self._path.name}",
+                )
+            return self._executor
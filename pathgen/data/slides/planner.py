@@ -0,0 +1,121 @@
+from typing import List, NamedTuple, Sequence
+
+import numpy as np
+
+from pathgen.data.slides.region import Region
+from pathgen.utils.geometry import Point, Size
+
+
+class ReadGroup(NamedTuple):
+    region: Region  # the bounding region that is read from the slide
+    indices: List[int]  # the positions of the grouped regions in the input list
+    offsets: List[Point]  # where each grouped region starts in the bounding region
+
+
+def _bounds(boxes: np.ndarray) -> np.ndarray:
+    return np.array(
+        [boxes[:, 0].min(), boxes[:, 1].min(), boxes[:, 2].max(), boxes[:, 3].max()]
+    )
+
+
+def _waste(boxes: np.ndarray) -> float:
+    left, top, right, bottom = _bounds(boxes)
+    area = (right - left) * (bottom - top)
+    covered = ((boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])).sum()
+    return 1 - min(covered, area) / area
+
+
+def _split(
+    indices: np.ndarray, boxes: np.ndarray, max_waste: float, groups: List[np.ndarray]
+) -> None:
+    # split a group into quadrants until each part wastes little enough of its read
+    if len(indices) == 1 or _waste(boxes[indices]) <= max_waste:
+        groups.append(indices)
+        return
+    left, top, right, bottom = _bounds(boxes[indices])
+    quadrant = (boxes[indices, 0] >= (left + right) / 2).astype(int)
+    quadrant += 2 * (boxes[indices, 1] >= (top + bottom) / 2)
+    if len(np.unique(quadrant)) == 1:
+        groups.extend(indices[:, np.newaxis])
+        return
+    for q in np.unique(quadrant):
+        _split(indices[quadrant == q], boxes, max_waste, groups)
+
+
+def plan_reads(
+    regions: Sequence[Region],
+    level_downsamples: Sequence[float],
+    max_read_size: int = 2048,
+    max_waste: float = 0.25,
+) -> List[ReadGroup]:
+    """ Group nearby regions on the same level into fewer, larger bounding box reads.
+
+    Each level is divided into square cells and the regions that start in the same
+    cell are grouped, with the cell size chosen so a group is never wider or taller
+    than max_read_size. Groups that waste more than max_waste of their bounding box
+    on pixels that no region needs are split into quadrants until they do not. The
+    wasted area is estimated from the sum of the region areas, so overlapping regions
+    count as covering more.
+
+    Args:
+        regions: The regions to read. Locations are at level 0 and sizes at the region level.
+        level_downsamples: The downsample of each level of the slide.
+        max_read_size: The largest width or height of a grouped read at its level.
+        max_waste: The largest fraction of a grouped read that is not in any region.
+
+    Returns:
+        The groups in row major order for each level, which together contain every
+        region once.
+    """
+    if len(regions) == 0:
+        return []
+
+    # work in pixel coordinates at each region's level
+    levels = np.array([region.level for region in regions])
+    boxes = np.empty((len(regions), 4), dtype=np.int64)
+    for idx, region in enumerate(regions):
+        x, y = region.location
+        width, height = region.size
+        downsample = level_downsamples[region.level]
+        left, top = int(x // downsample), int(y // downsample)
+        boxes[idx] = (left, top, left + width, top + height)
+
+    groups = []
+    for level in np.unique(levels):
+        indices = np.flatnonzero(levels == level)
+        sizes = boxes[indices, 2:] - boxes[indices, :2]
+        cell = max(1, max_read_size - int(sizes.max()) + 1)
+        cols = boxes[indices, 0] // cell
+        rows = boxes[indices, 1] // cell
+        order = np.lexsort((cols, rows))
+        keys = np.stack([rows[order], cols[order]], axis=1)
+        starts = np.flatnonzero(np.any(np.diff(keys, axis=0) != 0, axis=1)) + 1
+        for cell_indices in np.split(indices[order], starts):
+            _split(cell_indices, boxes, max_waste, groups)
+
+    plan = []
+    for group in groups:
+        group_boxes = boxes[group]
+        left, top, right, bottom = (int(v) for v in _bounds(group_boxes))
+        level = int(levels[group[0]])
+        downsample = level_downsamples[level]
+        location = Point(int(round(left * downsample)), int(round(top * downsample)))
+        size = Size(right - left, bottom - top)
+        offsets = [Point(int(b[0]) - left, int(b[1]) - top) for b in group_boxes]
+        region = Region(level, location, size)
+        plan.append(ReadGroup(region, [int(i) for i in group], offsets))
+    return plan
+
+
+def slice_reads(
+    regions: Sequence[Region], plan: List[ReadGroup], blocks: List[np.ndarray]
+) -> List[np.ndarray]:
+    """Cut the pixels of each region out of the grouped reads as views, in input order."""
+    patches = [None] * len(regions)
+    for group, block in zip(plan, blocks):
+        for idx, offset in zip(group.indices, group.offsets):
+            width, height = regions[idx].size
+            patches[idx] = block[
+                offset.y : offset.y + height, offset.x : offset.x + width
+            ]
+    return patches
@@ -0,0 +1,105 @@
+import os
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Lock
+from typing import Callable, Iterator
+
+from pathgen.data.slides.slide import SlideBase
+
+SlideFactory = Callable[[Path], SlideBase]
+
+
+class _PooledSlide:
+    def __init__(self, slide: SlideBase) -> None:
+        self.slide = slide
+        self.users = 0
+
+
+class SlidePool:
+    def __init__(self, max_open: int = 16) -> None:
+        """ A thread safe pool of open slide handles keyed by slide path.
+
+        Slides are opened the first time they are acquired and stay open after they
+        are released, so reading patches from the same slide in any order only parses
+        the slide file once. When more than max_open slides are open the least recently
+        used slides that are not in use are closed.
+
+        Handles are shared, several threads can use the same slide at once. The pool
+        belongs to the process that created it, in a forked child process it starts
+        again with no open slides rather than reusing the parent's file handles.
+
+        Args:
+            max_open (int, optional): The maximum number of open slides to keep. This
+                can be exceeded while more slides than this are in use. Defaults to 16.
+        """
+        self.max_open = max_open
+        self._slides = OrderedDict()
+        self._lock = Lock()
+        self._pid = os.getpid()
+
+    def __len__(self) -> int:
+        return len(self._slides)
+
+    def acquire(self, path: Path, slide_cls: SlideFactory) -> SlideBase:
+        """ Get an open slide for path, opening it with slide_cls if it is not in the pool.
+
+        Every call must be paired with a call to release.
+        """
+        key = str(path)
+        with self._lock:
+            self._check_process()
+            pooled = self._slides.get(key)
+            if pooled is None:
+                slide = slide_cls(path)
+                slide.open()
+                pooled = _PooledSlide(slide)
+                self._slides[key] = pooled
+            self._slides.move_to_end(key)
+            pooled.users += 1
+            self._evict()
+            return pooled.slide
+
+    def release(self, path: Path) -> None:
+        key = str(path)
+        with self._lock:
+            self._check_process()
+            pooled = self._slides.get(key)
+            if pooled is not None:
+                pooled.users -= 1
+                self._evict()
+
+    @contextmanager
+    def borrow(self, path: Path, slide_cls: SlideFactory) -> Iterator[SlideBase]:
+        slide = self.acquire(path, slide_cls)
+        try:
+            yield slide
+        finally:
+            self.release(path)
+
+    def close_all(self) -> None:
+        """Close all the slides in the pool that are not in use."""
+        with self._lock:
+            self._check_process()
+            for key in [k for k, p in self._slides.items() if p.users == 0]:
+                self._slides.pop(key).slide.close()
+
+    def _evict(self) -> None:
+        if len(self._slides) <= self.max_open:
+            return
+        idle = [k for k, p in self._slides.items() if p.users == 0]
+        for key in idle[: len(self._slides) - self.max_open]:
+            self._slides.pop(key).slide.close()
+
+    def _check_process(self) -> None:
+        if self._pid != os.getpid():
+            self._slides = OrderedDict()
+            self._pid = os.getpid()
+
+
+_default_pool = SlidePool()
+
+
+def get_slide_pool() -> SlidePool:
+    """The pool shared by all datasets in this process."""
+    return _default_pool
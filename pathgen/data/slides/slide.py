@@ -1,10 +1,12 @@
 from abc import ABCMeta, abstractmethod
 from pathlib import Path
-from typing import List
+from typing import Iterator, List, Tuple
 
+import cv2
 import numpy as np
 from PIL import Image
-from pathgen.utils.geometry import Size
+from pathgen.utils.geometry import Point, Size
+from pathgen.data.slides.planner import plan_reads, slice_reads
 from pathgen.data.slides.region import Region
 
 
@@ -34,6 +36,12 @@ class SlideBase(metaclass=ABCMeta):
     def dimensions(self) -> List[Size]:
         raise NotImplementedError
 
+    @property
+    def level_downsamples(self) -> List[float]:
+        """The downsample factor of each level relative to level 0."""
+        width = self.dimensions[0].width
+        return [width / dim.width for dim in self.dimensions]
+
     @abstractmethod
     def read_region(self, region: Region) -> Image:
         raise NotImplementedError
@@ -42,11 +50,157 @@ class SlideBase(metaclass=ABCMeta):
     def read_regions(self, regions: List[Region]) -> Image:
         raise NotImplementedError
 
-    def get_thumbnail(self, level: int) -> np.array:
-        # TODO: check this downscaling is ok
-        size = self.dimensions[level]
-        region = Region(level=level, location=(0, 0), size=size)
-        im = self.read_region(region)
-        im = im.convert("RGB")
-        im = np.asarray(im)
-        return im
+    def read_region_into(self, region: Region, out: np.ndarray) -> np.ndarray:
+        """ Read a region as RGB pixels directly into an existing array.
+
+        This lets loaders fill a slot of a batch array, e.g. batch[i], without
+        allocating a new array for every patch. Subclasses that can decode straight
+        into the array should override this, the default copies from read_region.
+
+        Args:
+            region (Region): The region to read.
+            out (np.ndarray): A uint8 array of shape (height, width, 3) to write to.
+
+        Returns:
+            np.ndarray: The out array.
+        """
+        check_region_buffer(region, out)
+        image = self.read_region(region)
+        np.copyto(out, np.asarray(image)[:, :, :3])
+        return out
+
+    def read_regions_coalesced(
+        self,
+        regions: List[Region],
+        max_read_size: int = 2048,
+        max_waste: float = 0.25,
+        max_workers: int = None,
+    ) -> List[np.ndarray]:
+        """ Read many regions with a few large reads of the areas that contain them.
+
+        Nearby regions on the same level, such as the patches on a grid, are grouped
+        by plan_reads into bounding box reads and each region is returned as a view
+        into the read that contains it.
+
+        Args:
+            regions (List[Region]): The regions to read.
+            max_read_size (int, optional): The largest width or height of a read.
+                Defaults to 2048.
+            max_waste (float, optional): The largest fraction of a read that is not
+                in any region. Defaults to 0.25.
+            max_workers (int, optional): Limit the number of concurrent reads, for
+                slides that read concurrently. Defaults to None, no limit.
+
+        Returns:
+            List[np.ndarray]: An RGB uint8 array for each region, in input order.
+        """
+        plan = plan_reads(regions, self.level_downsamples, max_read_size, max_waste)
+        blocks = self._read_blocks([group.region for group in plan], max_workers)
+        return slice_reads(regions, plan, blocks)
+
+    def _read_blocks(
+        self, regions: List[Region], max_workers: int = None
+    ) -> List[np.ndarray]:
+        blocks = []
+        for region in regions:
+            width, height = region.size
+            block = np.empty((height, width, 3), dtype=np.uint8)
+            blocks.append(self.read_region_into(region, block))
+        return blocks
+
+    def get_thumbnail(self, level: int, tile_size: int = 2048) -> np.array:
+        """ Get an RGB image of the whole slide at a given level.
+
+        The image is read in tiles of at most tile_size pixels square and copied into
+        a preallocated array, so the memory used is the output plus a single tile.
+        If the level is deeper than the slide's pyramid, the thumbnail has the size of
+        level 0 divided by 2 ** level and is downsampled tile by tile from the nearest
+        level that the slide does have.
+
+        Args:
+            level (int): The level of the thumbnail.
+            tile_size (int, optional): The width and height of the tiles read from the
+                slide. Defaults to 2048.
+
+        Returns:
+            np.array: A uint8 array of shape (height, width, 3).
+        """
+        size = self.thumbnail_size(level)
+        thumbnail = np.empty((size.height, size.width, 3), dtype=np.uint8)
+        for _ in self.iter_thumbnail_tiles(level, tile_size, out=thumbnail):
+            pass
+        return thumbnail
+
+    def thumbnail_size(self, level: int) -> Size:
+        """The size of the thumbnail at a level, which can be deeper than the pyramid."""
+        if level < len(self.dimensions):
+            return self.dimensions[level]
+        width, height = self.dimensions[0]
+        return Size(max(1, width // 2 ** level), max(1, height // 2 ** level))
+
+    def iter_thumbnail_tiles(
+        self, level: int, tile_size: int = 2048, out: np.ndarray = None
+    ) -> Iterator[Tuple[Point, np.ndarray]]:
+        """ Read the thumbnail at a level one tile at a time, see get_thumbnail.
+
+        Args:
+            level (int): The level of the thumbnail.
+            tile_size (int, optional): The width and height of the tiles read from the
+                slide. Defaults to 2048.
+            out (np.ndarray, optional): A uint8 array of shape (height, width, 3) for
+                the whole thumbnail to read the tiles into. Defaults to None, which
+                reads each tile into the same buffer, so it is only valid until the
+                next tile is read.
+
+        Yields:
+            Tuple[Point, np.ndarray]: The location of each tile in the thumbnail and its
+                pixels.
+        """
+        # find the level to read from and how much it has to be downsampled
+        size = self.thumbnail_size(level)
+        if level < len(self.dimensions):
+            source_level, factor = level, 1
+        else:
+            source_level = len(self.dimensions) - 1
+            factor = 2 ** level / self.level_downsamples[source_level]
+            factor = max(1, int(round(factor)))
+        source_downsample = self.level_downsamples[source_level]
+
+        # each output tile is read from a factor times bigger tile at the source level
+        out_tile = max(1, tile_size // factor)
+        if factor > 1:
+            buffer = np.empty((out_tile * factor, out_tile * factor, 3), dtype=np.uint8)
+        if out is None:
+            tile_buffer = np.empty((out_tile, out_tile, 3), dtype=np.uint8)
+        for top in range(0, size.height, out_tile):
+            for left in range(0, size.width, out_tile):
+                width = min(out_tile, size.width - left)
+                height = min(out_tile, size.height - top)
+                location = Point(
+                    int(round(left * factor * source_downsample)),
+                    int(round(top * factor * source_downsample)),
+                )
+                read_size = Size(width * factor, height * factor)
+                region = Region(source_level, location, read_size)
+                if out is None:
+                    tile = tile_buffer[:height, :width]
+                else:
+                    tile = out[top : top + height, left : left + width]
+                if factor > 1:
+                    source = buffer[: read_size.height, : read_size.width]
+                    self.read_region_into(region, source)
+                    tile[:] = cv2.resize(
+                        source, (width, height), interpolation=cv2.INTER_AREA
+                    )
+                else:
+                    self.read_region_into(region, tile)
+                yield Point(left, top), tile
+
+
+def check_region_buffer(region: Region, out: np.ndarray) -> None:
+    width, height = region.size
+    if out.shape != (height, width, 3) or out.dtype != np.uint8:
+        raise ValueError(
+            f"Expected a uint8 array of shape {(height, width, 3)} "
+            f"but got {out.dtype} {out.shape}."
+        )
@@ -0,0 +1,203 @@
+import time
+import zlib
+from math import ceil
+from pathlib import Path
+from typing import List, NamedTuple
+
+import numpy as np
+from PIL import Image
+
+from pathgen.data.slides.region import Region
+from pathgen.data.slides.slide import SlideBase, check_region_buffer
+from pathgen.utils.geometry import PointF, Size
+
+background_colour = np.array([236, 234, 240])
+tissue_colour = np.array([222, 148, 192])
+tumour_colour = np.array([142, 78, 164])
+
+
+class Ellipse(NamedTuple):
+    cx: float
+    cy: float
+    rx: float
+    ry: float
+    angle: float
+
+    def contains(self, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        cos, sin = np.cos(self.angle), np.sin(self.angle)
+        dx, dy = xs - self.cx, ys - self.cy
+        u = (dx * cos + dy * sin) / self.rx
+        v = (dy * cos - dx * sin) / self.ry
+        return u * u + v * v <= 1
+
+    def polygon(self, num_vertices: int = 64) -> List[PointF]:
+        t = np.linspace(0, 2 * np.pi, num_vertices, endpoint=False)
+        cos, sin = np.cos(self.angle), np.sin(self.angle)
+        xs = self.cx + self.rx * np.cos(t) * cos - self.ry * np.sin(t) * sin
+        ys = self.cy + self.rx * np.cos(t) * sin + self.ry * np.sin(t) * cos
+        return [PointF(float(x), float(y)) for x, y in zip(xs, ys)]
+
+
+class SyntheticLayout(NamedTuple):
+    tissue: List[Ellipse]
+    tumours: List[Ellipse]
+
+    @classmethod
+    def generate(
+        cls, name: str, size: Size, num_blobs: int, num_tumours: int
+    ) -> "SyntheticLayout":
+        """ A random but repeatable layout of tissue and tumour for the slide called name."""
+        rng = np.random.RandomState(zlib.crc32(name.encode()))
+        width, height = size
+        scale = min(width, height)
+        tissue = []
+        for _ in range(num_blobs):
+            tissue.append(
+                Ellipse(
+                    cx=rng.uniform(0.2, 0.8) * width,
+                    cy=rng.uniform(0.2, 0.8) * height,
+                    rx=rng.uniform(0.08, 0.2) * scale,
+                    ry=rng.uniform(0.08, 0.2) * scale,
+                    angle=rng.uniform(0, np.pi),
+                )
+            )
+        tumours = []
+        for idx in range(num_tumours):
+            blob = tissue[idx % len(tissue)]
+            tumours.append(
+                Ellipse(
+                    cx=blob.cx + rng.uniform(-0.3, 0.3) * blob.rx,
+                    cy=blob.cy + rng.uniform(-0.3, 0.3) * blob.ry,
+                    rx=rng.uniform(0.2, 0.5) * blob.rx,
+                    ry=rng.uniform(0.2, 0.5) * blob.ry,
+                    angle=rng.uniform(0, np.pi),
+                )
+            )
+        return cls(tissue, tumours)
+
+
+class SyntheticSlide(SlideBase):
+    def __init__(
+        self,
+        path: Path,
+        size: Size = Size(32768, 24576),
+        num_levels: int = 7,
+        tile_size: int = 256,
+        num_blobs: int = 4,
+        num_tumours: int = 2,
+        decode_cost: float = 0.0,
+    ) -> None:
+        """ A procedurally generated pyramidal slide, for tests and benchmarks without slide files.
+
+        The slide has a light background with elliptical blobs of tissue, some of which
+        contain elliptical tumours. The layout is generated from the name of the slide
+        file, which does not need to exist, so a slide and its annotations from
+        SyntheticLayout always agree. The pixels are a function of their level 0
+        location, so overlapping reads return the same values.
+
+        To mimic the cost of decoding a real slide each read sleeps for decode_cost
+        seconds for every tile_size tile that it touches, releasing the GIL as
+        OpenSlide does.
+
+        Args:
+            path (Path): The path of the slide, only its name is used.
+            size (Size, optional): The size of level 0. Defaults to Size(32768, 24576).
+            num_levels (int, optional): The number of levels, each half the size of the
+                one above. Defaults to 7.
+            tile_size (int, optional): The size of the simulated tiles. Defaults to 256.
+            num_blobs (int, optional): The number of tissue blobs. Defaults to 4.
+            num_tumours (int, optional): The number of tumours. Defaults to 2.
+            decode_cost (float, optional): Seconds to sleep per tile read. Defaults to 0.
+        """
+        self._path = Path(path)
+        self._size = Size(*size)
+        self._num_levels = num_levels
+        self._tile_size = tile_size
+        self._decode_cost = decode_cost
+        self.layout = SyntheticLayout.generate(
+            self._path.stem, self._size, num_blobs, num_tumours
+        )
+
+    def open(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    @property
+    def path(self) -> Path:
+        return self._path
+
+    @property
+    def dimensions(self) -> List[Size]:
+        width, height = self._size
+        return [
+            Size(max(1, width // 2 ** level), max(1, height // 2 ** level))
+            for level in range(self._num_levels)
+        ]
+
+    @property
+    def level_downsamples(self) -> List[float]:
+        return [float(2 ** level) for level in range(self._num_levels)]
+
+    def read_region(self, region: Region) -> Image:
+        width, height = region.size
+        image = np.zeros((height, width, 4), dtype=np.uint8)
+        inside = self._render(region, image[:, :, :3])
+        image[:, :, 3] = inside * 255
+        return Image.fromarray(image, "RGBA")
+
+    def read_regions(self, regions: List[Region]) -> Image:
+        return [self.read_region(region) for region in regions]
+
+    def read_region_into(self, region: Region, out: np.ndarray) -> np.ndarray:
+        check_region_buffer(region, out)
+        self._render(region, out)
+        return out
+
+    def _render(self, region: Region, out: np.ndarray) -> np.ndarray:
+        x, y = region.location
+        width, height = region.size
+        downsample = 2 ** region.level
+        left, top = int(x // downsample), int(y // downsample)
+        self._simulate_decode(left, top, width, height)
+
+        # the level 0 coordinates of the centre of each pixel
+        cols = np.arange(left, left + width)
+        rows = np.arange(top, top + height)
+        xs = ((cols + 0.5) * downsample)[np.newaxis, :]
+        ys = ((rows + 0.5) * downsample)[:, np.newaxis]
+
+        tissue = np.zeros((height, width), dtype=bool)
+        for blob in self.layout.tissue:
+            tissue |= blob.contains(xs, ys)
+        tumour = np.zeros((height, width), dtype=bool)
+        for blob in self.layout.tumours:
+            tumour |= blob.contains(xs, ys)
+        tumour &= tissue
+
+        out[:] = background_colour
+        out[tissue] = tissue_colour
+        out[tumour] = tumour_colour
+
+        # add some repeatable texture to the tissue, the background is left flat as
+        # darkening it changes its saturation, which is what tissue detection uses
+        noise = (xs.astype(np.int64) * 73856093) ^ (ys.astype(np.int64) * 19349663)
+        noise = ((noise >> 7) & 15).astype(np.uint8)
+        out[tissue] -= np.broadcast_to(noise, tissue.shape)[tissue][:, np.newaxis]
+
+        # like openslide, pixels outside the slide are transparent black
+        level_width, level_height = self.dimensions[region.level]
+        inside = ((cols >= 0) & (cols < level_width))[np.newaxis, :] & (
+            (rows >= 0) & (rows < level_height)
+        )[:, np.newaxis]
+        out[~inside] = 0
+        return inside
+
+    def _simulate_decode(self, left: int, top: int, width: int, height: int) -> None:
+        if self._decode_cost <= 0:
+            return
+        ts = self._tile_size
+        num_cols = ceil((left + width) / ts) - left // ts
+        num_rows = ceil((top + height) / ts) - top // ts
+        time.sleep(self._decode_cost * num_cols * num_rows)
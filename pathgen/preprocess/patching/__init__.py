@@ -1,4 +1,6 @@
 from .make_index import *
 from .patch_finder import *
 from .patchset import *
+from .export import *
 from .slides_index import *
+from .patch_store import *
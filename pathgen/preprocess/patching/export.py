@@ -0,0 +1,280 @@
+import io
+import json
+import multiprocessing
+import os
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+from math import ceil
+from pathlib import Path
+from threading import local
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import cv2
+import numpy as np
+import pandas as pd
+
+from pathgen.data.datasets import get_dataset
+from pathgen.data.datasets.registry import register_dataset
+from pathgen.data.slides import Region, SlideBase
+from pathgen.preprocess.patching.patchset import PatchSet
+from pathgen.utils.concurrency import bounded_imap
+
+
+class Codec(NamedTuple):
+    extension: str
+    flag: int  # the cv2.imwrite parameter that sets the compression
+
+
+codecs = {
+    "png": Codec(".png", cv2.IMWRITE_PNG_COMPRESSION),  # 0 to 9, larger is smaller
+    "jpg": Codec(".jpg", cv2.IMWRITE_JPEG_QUALITY),  # 0 to 100, larger is better
+    "webp": Codec(".webp", cv2.IMWRITE_WEBP_QUALITY),  # 1 to 100, above 100 lossless
+}
+
+export_columns = ["x", "y", "level", "patch_size", "label"]
+SHARDS_INDEX = "shards.json"
+
+
+def _codec_params(codec: str, compression: Optional[int]) -> Tuple[str, List[int]]:
+    extension, flag = codecs[codec]
+    return extension, [] if compression is None else [flag, compression]
+
+
+def _encode_patch(
+    slide: SlideBase, region: Region, buffers: local, extension: str, params: List
+) -> np.ndarray:
+    # each thread reuses its pixel buffers for every patch of the same size
+    shape = region.size.as_shape() + (3,)
+    by_shape = getattr(buffers, "by_shape", None)
+    if by_shape is None:
+        by_shape = buffers.by_shape = {}
+    if shape not in by_shape:
+        by_shape[shape] = [np.empty(shape, dtype=np.uint8) for _ in range(2)]
+    rgb, bgr = by_shape[shape]
+    slide.read_region_into(region, rgb)
+    cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR, dst=bgr)
+    _, encoded = cv2.imencode(extension, bgr, params)
+    return encoded
+
+
+def _imap_threads(fn: Callable, items: List, num_threads: int) -> Iterator:
+    if num_threads <= 1:
+        yield from map(fn, items)
+        return
+    # openslide and the encoders release the GIL, so reads and encodes overlap
+    with ThreadPoolExecutor(num_threads) as executor:
+        yield from bounded_imap(executor, fn, items, 2 * num_threads)
+
+
+def _run_tasks(fn: Callable, tasks: List[Tuple], num_workers: int) -> Iterator:
+    if num_workers > 0:
+        ctx = multiprocessing.get_context("spawn")
+        with ctx.Pool(num_workers) as pool:
+            yield from pool.imap_unordered(fn, tasks)
+    else:
+        for task in tasks:
+            yield fn(task)
+
+
+def _export_slide(args: Tuple) -> Tuple[int, int]:
+    dataset, slide_idx, columns, output_dir, codec, compression, num_threads = args
+    # worker processes are spawned, so they only know the registered data sets
+    register_dataset(dataset)
+    extension, params = _codec_params(codec, compression)
+    stem = dataset.get_slide_path(slide_idx).stem
+    buffers = local()
+
+    def save_patch(row: Tuple) -> None:
+        x, y, level, size, label = row
+        region = Region.make(x, y, size, level)
+        encoded = _encode_patch(slide, region, buffers, extension, params)
+        encoded.tofile(str(output_dir / label / f"{stem}-{x}-{y}-{level}{extension}"))
+
+    rows = list(zip(*(columns[name].tolist() for name in export_columns)))
+    with dataset.borrow_slide(slide_idx) as slide:
+        for _ in _imap_threads(save_patch, rows, num_threads):
+            pass
+    return slide_idx, len(rows)
+
+
+def export_patches(
+    patchset: PatchSet,
+    output_dir: Path,
+    codec: str = "png",
+    compression: int = None,
+    num_workers: int = 0,
+    num_threads: int = 4,
+) -> None:
+    """ Write every patch in a patch set as an image file in a directory for its label.
+
+    The patches are named {slide}-{x}-{y}-{level} after the slide file they are
+    from. The columns are split up by slide up front and the label directories are
+    made once, then each slide is exported by a worker process, with a thread pool
+    that reads and encodes several of its patches at once.
+
+    Args:
+        patchset (PatchSet): The patches to export.
+        output_dir (Path): The directory to write the label directories to.
+        codec (str, optional): The image format, one of "png", "jpg" or "webp".
+            Defaults to "png".
+        compression (int, optional): The png compression level from 0 to 9, or the
+            jpg or webp quality from 0 to 100. Defaults to None, OpenCV's default.
+        num_workers (int, optional): The number of processes to export the slides
+            in parallel. Defaults to 0, which exports them in this process.
+        num_threads (int, optional): The number of threads to read and encode the
+            patches of each slide. Defaults to 4.
+    """
+    if codec not in codecs:
+        raise ValueError(f"Unknown codec {codec}, expected one of {list(codecs)}.")
+    output_dir = Path(output_dir)
+    columns = {name: patchset.column(name) for name in export_columns}
+
+    # convert the labels to names once for each data set rather than for each patch
+    label_names = {}
+    label_dirs = set()
+    tasks = []
+    for (dataset_name, slide_idx), positions in patchset.slide_groups():
+        dataset = get_dataset(dataset_name)
+        if dataset_name not in label_names:
+            label_names[dataset_name] = dataset.labels_by_index
+        slide_columns = {name: values[positions] for name, values in columns.items()}
+        labels = pd.Series(slide_columns["label"]).map(label_names[dataset_name])
+        slide_columns["label"] = labels.to_numpy()
+        label_dirs.update(labels.unique())
+        tasks.append(
+            (
+                dataset,
+                int(slide_idx),
+                slide_columns,
+                output_dir,
+                codec,
+                compression,
+                num_threads,
+            )
+        )
+
+    for label in label_dirs:
+        (output_dir / label).mkdir(parents=True, exist_ok=True)
+
+    print("Exporting patches for: ", end="", flush=True)
+    for slide_idx, _ in _run_tasks(_export_slide, tasks, num_workers):
+        print(f"{slide_idx}", end=", ", flush=True)
+    print("Complete.")
+
+
+def _add_member(tar: tarfile.TarFile, name: str, data: bytes) -> None:
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def _write_shard(args: Tuple) -> Tuple[str, int]:
+    path, datasets, columns, codec, compression, num_threads = args
+    for dataset in datasets.values():
+        register_dataset(dataset)
+    extension, params = _codec_params(codec, compression)
+    buffers = local()
+    records = [dict(zip(columns, row)) for row in zip(*columns.values())]
+    stems = [record.pop("slide") for record in records]
+
+    def encode_patch(record: Dict) -> bytes:
+        dataset = datasets[record["dataset_name"]]
+        x, y, size, level = (record[k] for k in ["x", "y", "patch_size", "level"])
+        with dataset.borrow_slide(record["slide_index"]) as slide:
+            region = Region.make(x, y, size, level)
+            return _encode_patch(slide, region, buffers, extension, params).tobytes()
+
+    # write to a temporary file and rename so a shard is never read half written
+    # each patch is added as soon as it is encoded, in order, so only the few being
+    # encoded by the threads are held in memory rather than the whole shard
+    images = _imap_threads(encode_patch, records, num_threads)
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    with tarfile.open(tmp_path, "w") as tar:
+        for stem, record, image in zip(stems, records, images):
+            key = f"{stem}-{record['x']}-{record['y']}-{record['level']}"
+            _add_member(tar, f"{key}{extension}", image)
+            _add_member(tar, f"{key}.json", json.dumps(record).encode())
+    os.replace(tmp_path, path)
+    return path.name, len(records)
+
+
+def export_shards(
+    patchset: PatchSet,
+    output_dir: Path,
+    shard_size: int = 4096,
+    codec: str = "png",
+    compression: int = None,
+    num_workers: int = 0,
+    num_threads: int = 4,
+) -> None:
+    """ Write the patches into tar shards of shard_size patches each, to be streamed.
+
+    Each patch is stored as two consecutive files in a shard, the encoded image and
+    a json record of its label, label name, location, level, patch size, slide
+    index and data set name, both named {slide}-{x}-{y}-{level}. The patches are in
+    the order of the patch set, so sample or shuffle it first to mix the slides in
+    each shard. A shards.json file lists the shards and the number of patches in
+    each, for PatchShardDataset to read them with.
+
+    Args:
+        patchset (PatchSet): The patches to export.
+        output_dir (Path): The directory to write the shards to.
+        shard_size (int, optional): The number of patches in each shard. Defaults to 4096.
+        codec (str, optional): See export_patches. Defaults to "png".
+        compression (int, optional): See export_patches. Defaults to None.
+        num_workers (int, optional): The number of processes to write the shards in
+            parallel. Defaults to 0, which writes them in this process.
+        num_threads (int, optional): The number of threads to read and encode the
+            patches of each shard. Defaults to 4.
+    """
+    if codec not in codecs:
+        raise ValueError(f"Unknown codec {codec}, expected one of {list(codecs)}.")
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    names = export_columns + ["slide_index", "dataset_name"]
+    columns = {name: patchset.column(name) for name in names}
+
+    # the label names and slide file names are found once for each slide
+    num_patches = len(patchset.df)
+    label_names = np.empty(num_patches, dtype=object)
+    slides = np.empty(num_patches, dtype=object)
+    datasets = {}
+    for (dataset_name, slide_idx), positions in patchset.slide_groups():
+        if dataset_name not in datasets:
+            datasets[dataset_name] = get_dataset(dataset_name)
+        dataset = datasets[dataset_name]
+        labels = pd.Series(columns["label"][positions])
+        label_names[positions] = labels.map(dataset.labels_by_index).to_numpy()
+        slides[positions] = dataset.get_slide_path(slide_idx).stem
+    columns["label_name"] = label_names
+    columns["slide"] = slides
+
+    tasks = []
+    for shard in range(ceil(num_patches / shard_size)):
+        rows = slice(shard * shard_size, (shard + 1) * shard_size)
+        shard_columns = {
+            name: values[rows].tolist() for name, values in columns.items()
+        }
+        used = set(shard_columns["dataset_name"])
+        tasks.append(
+            (
+                output_dir / f"shard-{shard:06d}.tar",
+                {name: datasets[name] for name in used},
+                shard_columns,
+                codec,
+                compression,
+                num_threads,
+            )
+        )
+
+    counts = {}
+    print(f"Writing {len(tasks)} shards: ", end="", flush=True)
+    for name, count in _run_tasks(_write_shard, tasks, num_workers):
+        counts[name] = count
+        print(".", end="", flush=True)
+    print(" Complete.")
+
+    shards = [{"name": name, "count": counts[name]} for name in sorted(counts)]
+    index = {"codec": codec, "count": num_patches, "shards": shards}
+    with open(output_dir / SHARDS_INDEX, "w") as f:
+        json.dump(index, f)
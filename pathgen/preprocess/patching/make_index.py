@@ -1,11 +1,30 @@
+import json
+import multiprocessing
+import os
+import resource
+from multiprocessing.connection import Connection, wait
 from pathlib import Path
-from typing import List
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
 
 from pathgen.data.datasets import Dataset
+from pathgen.data.datasets.registry import register_dataset
 from pathgen.preprocess.tissue_detection import TissueDetector
 from pathgen.preprocess.patching.patch_finder import PatchFinder
 from pathgen.preprocess.patching.patchset import PatchSet
 from pathgen.preprocess.patching.slides_index import SlidesIndex
+from pathgen.utils.artefact_cache import ArtefactCache
+from pathgen.utils.json import to_json_params
+from pathgen.utils.paths import file_fingerprint
+
+MANIFEST_NAME = "manifest.json"
+
+
+def _cached(
+    cache: Optional[ArtefactCache], parts: Dict[str, Any], create: Callable
+) -> np.ndarray:
+    return create() if cache is None else cache.fetch(parts, create)
 
 
 def index_slide(
@@ -13,16 +32,55 @@ def index_slide(
     dataset: Dataset,
     tissue_detector: TissueDetector,
     patch_finder: PatchFinder,
+    render_tile_size: int = 4096,
+    cache: ArtefactCache = None,
+    max_untiled_pixels: int = 2 ** 28,
 ):
     slide_path, annotation_path, _, _ = dataset[slide_idx]
     with dataset.slide_cls(slide_path) as slide:
         print(f"indexing {slide_path.name}")  # TODO: Add proper logging!
-        annotations = dataset.load_annotations(annotation_path)
-        labels_shape = slide.dimensions[patch_finder.labels_level].as_shape()
-        scale_factor = 2 ** patch_finder.labels_level
-        labels_image = annotations.render(labels_shape, scale_factor)
-        tissue_mask = tissue_detector(slide.get_thumbnail(patch_finder.labels_level))
-        labels_image[~tissue_mask] = 0
+        labels_level = patch_finder.labels_level
+
+        # the labels image and tissue mask only depend on these, not the patch finder
+        slide_parts = {
+            "slide": file_fingerprint(slide_path) or str(slide_path),
+            "dimensions": slide.dimensions[0],
+            "level": labels_level,
+        }
+        # tiles can draw polygon edges a pixel differently from the whole image, so
+        # they are only used for labels images too large to render at once
+        labels_shape = slide.dimensions[labels_level].as_shape()
+        too_large = labels_shape.num_rows * labels_shape.num_cols > max_untiled_pixels
+        # every argument to render is in the key, so changing any renders again
+        render_args = {
+            "shape": labels_shape,
+            "factor": 2 ** labels_level,
+            "dtype": np.uint8,
+            "tile_size": render_tile_size if too_large else None,
+        }
+        labels_parts = {
+            "kind": "labels",
+            "annotation": file_fingerprint(annotation_path) or str(annotation_path),
+            "labels": dataset.labels,
+            "render": render_args,
+            **slide_parts,
+        }
+        tissue_parts = {
+            "kind": "tissue",
+            "detector": to_json_params(tissue_detector),
+            **slide_parts,
+        }
+
+        def render_labels() -> np.ndarray:
+            annotations = dataset.load_annotations(annotation_path)
+            return annotations.render(**render_args)
+
+        def detect_tissue() -> np.ndarray:
+            return tissue_detector.detect_slide(slide, labels_level)
+
+        labels_image = _cached(cache, labels_parts, render_labels)
+        tissue_mask = _cached(cache, tissue_parts, detect_tissue)
+        np.multiply(labels_image, tissue_mask, out=labels_image)
         df, level, size = patch_finder(
             labels_image, slide.dimensions[patch_finder.patch_level]
         )
@@ -30,11 +88,312 @@ def index_slide(
         return patchset
 
 
+def slide_manifest(
+    slide_idx: int,
+    dataset: Dataset,
+    tissue_detector: TissueDetector,
+    patch_finder: PatchFinder,
+) -> Dict:
+    """What the patch set for a slide depends on, to tell if a saved one is up to date."""
+    slide_path, annotation_path, _, _ = dataset[slide_idx]
+    manifest = {
+        "dataset": dataset.name,
+        "num_slides": len(dataset),
+        "slide_index": slide_idx,
+        "slide": file_fingerprint(slide_path) or str(slide_path),
+        "annotation": file_fingerprint(annotation_path) or str(annotation_path),
+        "tissue_detector": to_json_params(tissue_detector),
+        "patch_finder": to_json_params(patch_finder),
+    }
+    # round trip through json so it compares equal to a loaded manifest
+    return json.loads(json.dumps(manifest, default=str))
+
+
+def read_manifest(slide_dir: Path) -> Optional[Dict]:
+    try:
+        with open(slide_dir / MANIFEST_NAME) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_manifest(slide_dir: Path, manifest: Dict) -> None:
+    # write to a temporary file and rename so a manifest is never read half written
+    with open(slide_dir / f"{MANIFEST_NAME}.tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(slide_dir / f"{MANIFEST_NAME}.tmp", slide_dir / MANIFEST_NAME)
+
+
+def is_up_to_date(saved: Optional[Dict], manifest: Dict) -> bool:
+    """ Whether a saved manifest is for the same inputs as a new one.
+
+    The number of slides in the data set is not compared, it does not change the
+    patches of a slide, so adding slides to a data set only indexes the new ones.
+    """
+
+    def inputs(m: Dict) -> Dict:
+        return {key: value for key, value in m.items() if key != "num_slides"}
+
+    return saved is not None and inputs(saved) == inputs(manifest)
+
+
+def save_slide(patchset: PatchSet, slide_dir: Path, manifest: Dict) -> None:
+    """Save the patch set for a slide with the manifest written last, so an interrupted
+    save is never mistaken for an up to date one."""
+    manifest_path = slide_dir / MANIFEST_NAME
+    if manifest_path.exists():
+        manifest_path.unlink()
+    patchset.save(slide_dir)
+    write_manifest(slide_dir, manifest)
+
+
+def save_failure(slide_dir: Path, manifest: Dict, error: str) -> None:
+    """Record that a slide failed to be indexed, so it is indexed again next time."""
+    slide_dir.mkdir(parents=True, exist_ok=True)
+    write_manifest(slide_dir, {**manifest, "error": error})
+
+
+def _limit_memory(max_memory: Optional[int]) -> None:
+    # the address space limit makes large allocations raise MemoryError in the
+    # worker, rather than the whole machine running out of memory
+    if max_memory:
+        resource.setrlimit(resource.RLIMIT_AS, (max_memory, max_memory))
+
+
+def _try_index_slide(args: Tuple) -> Tuple[int, Optional[PatchSet], Optional[str]]:
+    slide_idx, dataset, tissue_detector, patch_finder, cache, output_dir = args
+    # worker processes are spawned, so they only know the registered data sets
+    register_dataset(dataset)
+    try:
+        patchset = index_slide(
+            slide_idx, dataset, tissue_detector, patch_finder, cache=cache
+        )
+        if output_dir is not None:
+            manifest = slide_manifest(slide_idx, dataset, tissue_detector, patch_finder)
+            save_slide(patchset, output_dir / str(slide_idx), manifest)
+        return slide_idx, patchset, None
+    except Exception as e:  # report the failure and carry on with the other slides
+        return slide_idx, None, f"{type(e).__name__}: {e}"
+
+
+def _index_in_worker(conn: Connection, task: Tuple, max_memory: Optional[int]) -> None:
+    _limit_memory(max_memory)
+    conn.send(_try_index_slide(task))
+    conn.close()
+
+
+def _index_in_processes(
+    tasks: List[Tuple], num_workers: int, max_memory: Optional[int]
+) -> Iterator[Tuple[int, Optional[PatchSet], Optional[str]]]:
+    """ Index each slide in a new process, with at most num_workers at once.
+
+    A new process for each slide returns all of its memory when it is done. A worker
+    that dies rather than raising, for example from a crash in a native library or
+    an abort when it runs out of memory, is reported as a failure of its slide.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    pending = list(reversed(tasks))
+    running = []
+    try:
+        while pending or running:
+            while pending and len(running) < num_workers:
+                task = pending.pop()
+                receiver, sender = ctx.Pipe(duplex=False)
+                process = ctx.Process(
+                    target=_index_in_worker, args=(sender, task, max_memory)
+                )
+                process.start()
+                sender.close()
+                running.append((task[0], process, receiver))
+
+            # a worker is done when it sends its result or when it exits
+            receivers = [receiver for _, _, receiver in running]
+            ready = wait(receivers + [process.sentinel for _, process, _ in running])
+            for item in list(running):
+                slide_idx, process, receiver = item
+                if receiver not in ready and process.sentinel not in ready:
+                    continue
+                try:
+                    result = receiver.recv()
+                except EOFError:  # it exited without sending a result
+                    result = None
+                process.join()
+                receiver.close()
+                running.remove(item)
+                if result is None:
+                    error = f"worker exited with code {process.exitcode}"
+                    result = (slide_idx, None, error)
+                yield result
+    finally:
+        for _, process, _ in running:
+            process.terminate()
+
+
 def make_index(
-    dataset: Dataset, tissue_detector: TissueDetector, patch_finder: PatchFinder
+    dataset: Dataset,
+    tissue_detector: TissueDetector,
+    patch_finder: PatchFinder,
+    cache: ArtefactCache = None,
+    num_workers: int = 0,
+    max_memory: int = None,
+    output_dir: Path = None,
+    indices: List[int] = None,
 ) -> SlidesIndex:
+    """ Find the patches in every slide of the data set.
+
+    A slide that fails to be indexed is reported and left out of the index, rather
+    than stopping the rest of the slides from being indexed, including when it
+    crashes its worker process. The patch sets are
+    always in the order of the slides in the data set.
+
+    If an output directory is given, each slide's patch set is saved there as soon
+    as it is indexed, as SlidesIndex.save would, with a manifest of the slide and
+    annotation files and the detector and finder parameters. When make_index is run
+    again, slides whose manifest has not changed are loaded rather than indexed, so
+    an interrupted run carries on where it stopped and only new or changed slides
+    are indexed.
+
+    Args:
+        dataset (Dataset): The slides to index.
+        tissue_detector (TissueDetector): Finds the tissue in each slide.
+        patch_finder (PatchFinder): Finds the patches from the labels image.
+        cache (ArtefactCache, optional): A cache for the labels images and tissue
+            masks, so that indexing again with a different patch finder does not
+            render or detect them again. Defaults to None.
+        num_workers (int, optional): The number of processes to index the slides in
+            parallel. Defaults to 0, which indexes them in this process.
+        max_memory (int, optional): The most memory in bytes each worker process can
+            allocate. A slide that needs more fails. The limit can not be undone in
+            this process, so it needs num_workers above 0 and raises a ValueError
+            otherwise. Defaults to None, no limit.
+        output_dir (Path, optional): The directory to save the index to as it is
+            made, and to resume from. Defaults to None.
+        indices (List[int], optional): Only index these slides, for example a shard
+            from shard_slides. Defaults to None, all the slides.
+
+    Returns:
+        SlidesIndex: The patches for each slide.
+    """
+    if max_memory and num_workers <= 0:
+        raise ValueError("max_memory only limits worker processes, set num_workers.")
+    # the patch sets from the worker processes look the data set up by name
+    register_dataset(dataset)
+    results = {}
+    tasks = []
+    indices = range(len(dataset)) if indices is None else sorted(indices)
+    for idx in indices:
+        if output_dir is not None:
+            slide_dir = output_dir / str(idx)
+            manifest = slide_manifest(idx, dataset, tissue_detector, patch_finder)
+            saved = read_manifest(slide_dir)
+            if is_up_to_date(saved, manifest):
+                if saved != manifest:
+                    # record the new number of slides for merge_index to check
+                    write_manifest(slide_dir, manifest)
+                results[idx] = (idx, PatchSet.load(slide_dir), None)
+                continue
+        tasks.append((idx, dataset, tissue_detector, patch_finder, cache, output_dir))
+    if results:
+        print(f"{len(results)} slides are up to date in {output_dir}")
+
+    def report(result: Tuple[int, Optional[PatchSet], Optional[str]]) -> None:
+        slide_idx, patchset, error = result
+        results[slide_idx] = result
+        slide_name = dataset.get_slide_path(slide_idx).name
+        progress = f"[{len(results)}/{len(indices)}] {slide_name}"
+        if error:
+            print(f"{progress} failed: {error}")
+            if output_dir is not None:
+                manifest = slide_manifest(
+                    slide_idx, dataset, tissue_detector, patch_finder
+                )
+                save_failure(output_dir / str(slide_idx), manifest, error)
+        else:
+            print(f"{progress} {len(patchset.df)} patches")
+
+    if num_workers > 0:
+        for result in _index_in_processes(tasks, num_workers, max_memory):
+            report(result)
+    else:
+        for task in tasks:
+            report(_try_index_slide(task))
+
+    failed = [idx for idx, (_, _, error) in sorted(results.items()) if error]
+    if failed:
+        print(f"{len(failed)} slides failed to be indexed: {failed}")
     patchsets = [
-        index_slide(idx, dataset, tissue_detector, patch_finder)
-        for idx in range(len(dataset))
+        patchset for _, (_, patchset, _) in sorted(results.items()) if patchset
     ]
     return SlidesIndex(patchsets)
+
+
+def shard_slides(dataset: Dataset, shard: int, num_shards: int) -> List[int]:
+    """ The slides for one of num_shards jobs that index a data set between them.
+
+    The slides are shared out so each shard has about the same total slide file size,
+    as an estimate of the time to index them, by giving the largest remaining slide
+    to the shard with the least so far. The result only depends on the data set, so
+    every job finds the same shards.
+
+    Args:
+        dataset (Dataset): The data set to shard.
+        shard (int): Which shard to get, from 0 to num_shards - 1.
+        num_shards (int): The number of shards.
+
+    Returns:
+        List[int]: The indices of the slides in the shard, in order.
+    """
+    if not 0 <= shard < num_shards:
+        raise ValueError(f"Shard {shard} is not in the range 0 to {num_shards - 1}.")
+
+    def cost(idx: int) -> int:
+        fingerprint = file_fingerprint(dataset.get_slide_path(idx))
+        return fingerprint["size"] if fingerprint else 1
+
+    costs = [cost(idx) for idx in range(len(dataset))]
+    totals = [0] * num_shards
+    shards = [[] for _ in range(num_shards)]
+    for idx in sorted(range(len(dataset)), key=lambda idx: (-costs[idx], idx)):
+        smallest = min(range(num_shards), key=lambda s: (totals[s], s))
+        totals[smallest] += costs[idx]
+        shards[smallest].append(idx)
+    return sorted(shards[shard])
+
+
+def merge_index(input_dirs: List[Path]) -> SlidesIndex:
+    """ Put the slides saved by make_index into several directories into one index.
+
+    Each slide directory has a manifest, so the slides are put back into the order of
+    the data set whichever directory they are in. Every manifest records the data set
+    and its number of slides, and they must all agree, so shards of different data
+    sets are never merged and the slides missing from every shard are reported.
+
+    Args:
+        input_dirs (List[Path]): The output directories of the shards, which can be
+            the same directory.
+
+    Returns:
+        SlidesIndex: The patches of every slide, in data set order.
+    """
+    slides = {}
+    datasets = set()
+    for input_dir in input_dirs:
+        for slide_dir in Path(input_dir).iterdir():
+            manifest = read_manifest(slide_dir)
+            if manifest is None:
+                continue
+            datasets.add((manifest["dataset"], manifest.get("num_slides")))
+            if "error" not in manifest:
+                slides[manifest["slide_index"]] = slide_dir
+
+    if not datasets:
+        raise ValueError(f"No indexed slides were found in {input_dirs}.")
+    if len(datasets) > 1 or None in dict(datasets).values():
+        raise ValueError(
+            f"The shards are not all of the same data set: {sorted(datasets, key=str)}"
+        )
+    ((dataset_name, num_slides),) = datasets
+    missing = sorted(set(range(num_slides)) - set(slides))
+    if missing:
+        print(f"{dataset_name} is missing {len(missing)} slides {missing}")
+    return SlidesIndex([PatchSet.load(slides[idx]) for idx in sorted(slides)])
@@ -1,12 +1,11 @@
 from abc import ABCMeta, abstractmethod
 from math import ceil
-from typing import Tuple
+from typing import Dict, List, NamedTuple, Tuple
 
 import numpy as np
 import pandas as pd
 
-from pathgen.utils.convert import to_frame_with_locations
-from pathgen.utils.filters import pool2d
+from pathgen.utils.filters import pool2d, pool2d_fractions
 from pathgen.utils.geometry import Size
 
 
@@ -29,10 +28,12 @@ class GridPatchFinder(PatchFinder):
         labels_level: int,
         patch_level: int,
         patch_size: int,
-        stride: int,  # defined in terms of the labels image space
+        stride: int,  # in pixels at the patch level
         border: int = 0,
         jitter: int = 0,
         remove_background: bool = True,
+        pool_mode: str = "max",
+        thresholds: Dict[int, float] = None,
     ) -> None:
         """ Note that the assumption is that the same settings will be used for a number of different patches.
 
@@ -41,9 +42,17 @@ class GridPatchFinder(PatchFinder):
             labels_level (int): The magnification level of the labels image.
             patch_level (int): The magnification level at which to extract the pixels data for the patches.
             patch_size (int): The width and height of the patches in pixels at patches_level magnification.
-            stride (int): The horizontal and vertical distance between each patch (the stide of the window).
+            stride (int): The horizontal and vertical distance between each patch (the stide of the window),
+                in pixels at patch_level. Patches overlap if it is less than patch_size.
             border (int, optional): [description]. Defaults to 0.
             jitter (int, optional): [description]. Defaults to None.
+            remove_background (bool, optional): Drop the patches labelled 0. Defaults to True.
+            pool_mode (str, optional): How to label a patch from the labels in it. "max" takes
+                the largest label and "majority" the label with the most area. Defaults to "max".
+            thresholds (Dict[int, float], optional): For "majority", labels that are only given
+                to a patch if at least this fraction of it has the label, e.g. {2: 0.5} for
+                patches that are at least half tumour. The largest label over its threshold is
+                used, otherwise the majority of the labels without thresholds. Defaults to None.
         """
 
         # assign values
@@ -54,6 +63,12 @@ class GridPatchFinder(PatchFinder):
         self.border = border
         self.jitter = jitter
         self.remove_background = remove_background
+        self.pool_mode = pool_mode
+        self.thresholds = thresholds or {}
+        if pool_mode not in ["max", "majority"]:
+            raise ValueError(f"Unknown pool mode {pool_mode}.")
+        if self.thresholds and pool_mode != "majority":
+            raise ValueError("Thresholds can only be used with the majority pool mode.")
         # some assumptions
         # 1. patch_size is some integer multiple of a pixel at labels_level
         # 2. patch_level is equal to or below labels_level
@@ -66,47 +81,185 @@ class GridPatchFinder(PatchFinder):
 
         Args:
             labels_image (np.array): An array containing a label index for each pixel at some magnification level.
+            slide_shape (Size): The size of the slide at the patch level.
 
         Returns:
             PatchIndex: A patch index containing data about how to retieve and label the patches for the slide.
+                The x and y are the level 0 location of the top left of each patch, as Region expects.
         """
-        scale_factor = 2 ** (self.labels_level - self.patch_level)
-        kernel_size = int(self.patch_size / scale_factor)
-        label_level_stride = int(self.stride / scale_factor)
+        x, y, labels, index = self.locations(labels_image, slide_shape)
+        downsample = 2 ** self.patch_level
+        df = pd.DataFrame(
+            {"x": x * downsample, "y": y * downsample, "label": labels}, index=index
+        )
+
+        # return the index and the data required to extract the patches later
+        return df, self.patch_level, self.patch_size + (self.border + self.jitter)
+
+    def locations(
+        self, labels_image: np.array, slide_shape: Size
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """ Find the patches to keep in the grid over the labels image.
 
-        # TODO - Needs to select no the max label but the one with the most area? - needs thinking about this!
-        # The pooling operation might be a parameter for the patch finder.
-        patch_labels = pool2d(labels_image, kernel_size, label_level_stride, 0)
+        Args:
+            labels_image (np.array): The label index of each pixel at the labels level.
+            slide_shape (Size): The size of the slide at the patch level.
 
-        # convert the 2d array of patch labels to a data frame
-        df = to_frame_with_locations(patch_labels, "label")
-        df.row *= self.patch_size
-        df.column *= self.patch_size
-        df = df.rename(columns={"row": "y", "column": "x"})
-        df = df.reindex(columns=["x", "y", "label"])
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]: The x and y of the
+                top left of each patch at the patch level, with the border and jitter
+                and clipped to the slide, its label, and its position in the grid as
+                row * number of columns + column.
+        """
+        patch_labels = self.pool_labels(labels_image)
+
+        # find the cells to keep, which are usually only the small fraction with tissue
+        if self.remove_background:
+            rows, cols = np.nonzero(patch_labels)
+        else:
+            rows, cols = np.indices(patch_labels.shape).reshape(2, -1)
+        labels = patch_labels[rows, cols]
 
         # calculate amount to subtract from top left for border and jitter
         subtract_top_left = ceil(self.border / 2) + self.jitter
-
-        # for each row, add the border
-        df["x"] = np.subtract(df["x"], subtract_top_left)
-        df["y"] = np.subtract(df["y"], subtract_top_left)
         output_patch_size = self.patch_size + (self.border + self.jitter)
 
-        # remove the background
-        if self.remove_background:
-            df = df[
-                df.label != 0
-            ]  # TODO: put this in as a method that is optional on the slide patch index (or something)
+        # the cells are stride apart, add the border and clip to the slide dimensions
+        x = cols.astype(np.int32) * self.stride - subtract_top_left
+        y = rows.astype(np.int32) * self.stride - subtract_top_left
+        np.clip(x, 0, slide_shape.width - output_patch_size, out=x)
+        np.clip(y, 0, slide_shape.height - output_patch_size, out=y)
 
-        # clip the patch coordinates to the slide dimensions
-        df["x"] = np.maximum(df["x"], 0)
-        df["y"] = np.maximum(df["y"], 0)
-        df["x"] = np.minimum(df["x"], slide_shape.width - output_patch_size)
-        df["y"] = np.minimum(df["y"], slide_shape.height - output_patch_size)
+        index = rows.astype(np.int64) * patch_labels.shape[1] + cols
+        return x, y, labels, index
 
-        # return the index and the data required to extract the patches later
-        return df, self.patch_level, output_patch_size
+    def pool_labels(self, labels_image: np.array) -> np.ndarray:
+        """The label of each cell of the grid of patches, in rows and columns."""
+        scale_factor = 2 ** (self.labels_level - self.patch_level)
+        kernel_size = int(self.patch_size / scale_factor)
+        label_level_stride = int(self.stride / scale_factor)
+
+        if self.pool_mode == "max":
+            return pool2d(labels_image, kernel_size, label_level_stride, 0)
+        fractions = pool2d_fractions(labels_image, kernel_size, label_level_stride)
+        return self.label_fractions(fractions)
+
+    def label_fractions(self, fractions: np.ndarray) -> np.ndarray:
+        """ Label each patch from the fraction of it with each label.
+
+        Args:
+            fractions (np.ndarray): The fractions from pool2d_fractions, (rows, cols, labels).
+
+        Returns:
+            np.ndarray: The label of each patch, (rows, cols).
+        """
+        num_labels = fractions.shape[2]
+        # larger labels first, so they win ties in the majority
+        others = [label for label in range(num_labels) if label not in self.thresholds]
+        others = others[::-1]
+
+        patch_labels = np.zeros(fractions.shape[:2], dtype=int)
+        if others:
+            majority = fractions[:, :, others].argmax(axis=2)
+            patch_labels = np.array(others)[majority]
+        for label in sorted(self.thresholds):
+            if label < num_labels:
+                over = fractions[:, :, label] >= self.thresholds[label]
+                patch_labels[over] = label
+        return patch_labels
 
     def labels_level(self):
         raise self.labels_level
+
+
+class PatchSpec(NamedTuple):
+    patch_level: int
+    patch_size: int
+    stride: int  # at the patch level
+
+
+class MultiLevelPatchFinder(PatchFinder):
+    def __init__(
+        self,
+        labels_level: int,
+        specs: List[Tuple[int, int, int]],
+        border: int = 0,
+        jitter: int = 0,
+        remove_background: bool = True,
+        pool_mode: str = "max",
+        thresholds: Dict[int, float] = None,
+    ) -> None:
+        """ Find grids of patches at several levels from the same labels image.
+
+        Each spec is found like a GridPatchFinder with the same settings, so the labels
+        image and tissue mask are only made once for all of the levels. The patches
+        for every level are returned in one frame with level and patch_size columns.
+        As for GridPatchFinder, x and y are the level 0 location of the top left of
+        each patch, so the patches at each level cover the same tissue.
+
+        Args:
+            labels_level (int): The magnification level of the labels image.
+            specs (List[Tuple[int, int, int]]): The patch level, patch size and stride
+                of each grid, with the size and stride in pixels at the patch level.
+            border (int, optional): See GridPatchFinder. Defaults to 0.
+            jitter (int, optional): See GridPatchFinder. Defaults to 0.
+            remove_background (bool, optional): Drop the patches labelled 0. Defaults to True.
+            pool_mode (str, optional): See GridPatchFinder. Defaults to "max".
+            thresholds (Dict[int, float], optional): See GridPatchFinder. Defaults to None.
+        """
+        self._labels_level = labels_level
+        self.patch_level = 0  # the slide shape is passed in at level 0
+        self.specs = [PatchSpec(*spec) for spec in specs]
+        self.finders = [
+            GridPatchFinder(
+                labels_level,
+                spec.patch_level,
+                spec.patch_size,
+                spec.stride,
+                border,
+                jitter,
+                remove_background,
+                pool_mode,
+                thresholds,
+            )
+            for spec in self.specs
+        ]
+
+    @property
+    def labels_level(self) -> int:
+        return self._labels_level
+
+    def __call__(
+        self, labels_image: np.array, slide_shape: Size
+    ) -> Tuple[pd.DataFrame, int, int]:
+        """ Find the patches at every level.
+
+        Args:
+            labels_image (np.array): An array containing a label index for each pixel at the labels level.
+            slide_shape (Size): The size of the slide at level 0.
+
+        Returns:
+            Tuple[pd.DataFrame, int, int]: The patches for all the levels, and None for
+                the level and patch size as they are columns of the frame.
+        """
+        frames = []
+        for finder in self.finders:
+            # find the grid at the patch level, then scale the locations to level 0
+            downsample = 2 ** finder.patch_level
+            level_shape = Size(
+                slide_shape.width // downsample, slide_shape.height // downsample
+            )
+            x, y, labels, _ = finder.locations(labels_image, level_shape)
+            output_patch_size = finder.patch_size + (finder.border + finder.jitter)
+            frame = pd.DataFrame(
+                {
+                    "x": x * downsample,
+                    "y": y * downsample,
+                    "label": labels,
+                    "level": np.full(len(x), finder.patch_level, dtype=np.int32),
+                    "patch_size": np.full(len(x), output_patch_size, dtype=np.int32),
+                }
+            )
+            frames.append(frame)
+        df = pd.concat(frames, ignore_index=True)
+        return df, None, None
@@ -0,0 +1,120 @@
+import json
+import tarfile
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple, TypeVar
+
+import cv2
+import numpy as np
+from torch.utils.data import IterableDataset, get_worker_info
+
+from pathgen.preprocess.patching.export import SHARDS_INDEX
+
+T = TypeVar("T")
+
+
+def read_shard(path: Path) -> Iterator[Tuple[bytes, Dict]]:
+    """ The encoded image and record of each patch in a shard written by export_shards.
+
+    The shard is read as a stream from start to end, without seeking.
+    """
+    image_key, image = None, None
+    with tarfile.open(path, "r|") as tar:
+        for member in tar:
+            key, extension = member.name.rsplit(".", 1)
+            data = tar.extractfile(member).read()
+            if extension != "json":
+                image_key, image = key, data
+            elif key == image_key:
+                yield image, json.loads(data)
+
+
+def buffered_shuffle(
+    items: Iterable[T], buffer_size: int, rng: np.random.Generator
+) -> Iterator[T]:
+    """ Shuffle a stream with a buffer that holds at most buffer_size items.
+
+    Each new item replaces a random item in the full buffer, which is yielded, so
+    items move at most about buffer_size places from where they were in the stream.
+    """
+    buffer = []
+    for item in items:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+            continue
+        idx = rng.integers(buffer_size)
+        yield buffer[idx]
+        buffer[idx] = item
+    rng.shuffle(buffer)
+    yield from buffer
+
+
+def decode_patch(data: bytes) -> np.ndarray:
+    bgr = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    return cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+
+
+class PatchShardDataset(IterableDataset):
+    def __init__(
+        self,
+        shard_dir: Path,
+        shuffle_buffer: int = 0,
+        seed: int = 0,
+        transform: Callable = None,
+    ) -> None:
+        """ Stream the patches from the shards written by export_shards.
+
+        Each shard is read in one sequential pass, so training makes a few large
+        reads rather than opening a file for every patch. With a DataLoader, the
+        shards are split between the workers, so each patch is read once an epoch.
+
+        If shuffle_buffer is more than zero, the order of the shards is shuffled and
+        the patches are shuffled with a buffer of that many encoded patches. Call
+        set_epoch before each epoch to get a different order every epoch.
+
+        Args:
+            shard_dir (Path): The output directory of export_shards.
+            shuffle_buffer (int, optional): The number of patches to shuffle within.
+                Defaults to 0, no shuffling.
+            seed (int, optional): The seed for the shuffling. Defaults to 0.
+            transform (Callable, optional): Applied to each RGB uint8 image, of shape
+                (height, width, 3). Defaults to None.
+        """
+        self.shard_dir = Path(shard_dir)
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.transform = transform
+        self.epoch = 0
+        with open(self.shard_dir / SHARDS_INDEX) as f:
+            self.index = json.load(f)
+
+    def __len__(self) -> int:
+        return self.index["count"]
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def worker_shards(self) -> List[Path]:
+        """The shards for this DataLoader worker, or all of them outside a worker."""
+        shards = [self.shard_dir / s["name"] for s in self.index["shards"]]
+        if self.shuffle_buffer > 0:
+            # the same order in every worker, so each shard goes to one worker
+            np.random.default_rng([self.seed, self.epoch]).shuffle(shards)
+        info = get_worker_info()
+        if info is None:
+            return shards
+        return shards[info.id :: info.num_workers]
+
+    def __iter__(self) -> Iterator[Tuple[np.ndarray, int]]:
+        shards = self.worker_shards()
+        samples = (sample for path in shards for sample in read_shard(path))
+        if self.shuffle_buffer > 0:
+            info = get_worker_info()
+            worker = 0 if info is None else info.id
+            rng = np.random.default_rng([self.seed, self.epoch, worker])
+            samples = buffered_shuffle(samples, self.shuffle_buffer, rng)
+        # the buffer holds the encoded images, they are only decoded when used
+        for data, record in samples:
+            image = decode_patch(data)
+            if self.transform is not None:
+                image = self.transform(image)
+            yield image, record["label"]
@@ -0,0 +1,100 @@
+from pathlib import Path
+from typing import Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from pathgen.data.datasets import get_dataset
+from pathgen.data.slides import Region
+from pathgen.preprocess.patching.patchset import PatchSet
+from pathgen.utils.columnar import read_columns, write_columns
+from pathgen.utils.json import to_json_value
+
+
+class PatchStore(Sequence):
+    """ A packed, memory mapped store of the pixels for every patch in a PatchSet.
+
+    The patches are stored in a single uint8 array file of shape (N, H, W, 3), which
+    is memory mapped when it is opened, so indexing the store returns views onto
+    the page cache rather than decoding an image file. The PatchSet frame is stored
+    next to it as columns, in the same order as the patches.
+
+    Args:
+        path (Path): A directory written by PatchStore.create.
+    """
+
+    images_file = "images.npy"
+    frame_file = "frame.cols"
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.images = np.load(path / self.images_file, mmap_mode="r")
+        columns, self.fields = read_columns(path / self.frame_file)
+        self.df = pd.DataFrame(columns)
+        self.labels = self.df["label"].to_numpy()
+
+    def __len__(self) -> int:
+        return len(self.images)
+
+    def __getitem__(self, idx: int) -> Tuple[np.ndarray, int]:
+        return self.images[idx], self.labels[idx]
+
+    def as_patchset(self) -> PatchSet:
+        return PatchSet(self.df, **self.fields)
+
+    @classmethod
+    def create(cls, patchset: PatchSet, output_dir: Path) -> "PatchStore":
+        """ Read all the patches in the patchset from their slides into a new store.
+
+        All the patches must be the same size. The patches are read slide by slide,
+        directly into the memory mapped output file.
+
+        Args:
+            patchset (PatchSet): The patches to store.
+            output_dir (Path): The directory to write the store to.
+
+        Returns:
+            PatchStore: The new store opened for reading.
+        """
+        sizes = np.unique(patchset.column("patch_size"))
+        if len(sizes) != 1:
+            raise ValueError(f"Patches must all be the same size, found sizes {sizes}.")
+        size = int(sizes[0])
+
+        output_dir.mkdir(parents=True, exist_ok=True)
+        num_patches = len(patchset.df)
+        images = np.lib.format.open_memmap(
+            output_dir / cls.images_file,
+            mode="w+",
+            dtype=np.uint8,
+            shape=(num_patches, size, size, 3),
+        )
+
+        xs, ys = patchset.column("x"), patchset.column("y")
+        levels = patchset.column("level")
+        print("Storing patches for: ", end="")
+        for (dataset_name, slide_idx), positions in patchset.slide_groups():
+            print(f"{slide_idx}", end=", ")
+            with get_dataset(dataset_name).borrow_slide(slide_idx) as slide:
+                for pos in positions:
+                    x, y, level = int(xs[pos]), int(ys[pos]), int(levels[pos])
+                    region = Region.make(x, y, size, level)
+                    slide.read_region_into(region, images[pos])
+        images.flush()
+        del images
+        print("Complete.")
+
+        # the frame is stored with the same fields as PatchSet.save
+        columns = {}
+        for name, series in patchset.df.items():
+            values = series.to_numpy()
+            columns[name] = values.astype(str) if values.dtype.hasobject else values
+        fields = {
+            "patch_size": patchset._patch_size,
+            "level": patchset._level,
+            "slide_index": patchset._slide_index,
+            "dataset_name": patchset._dataset_name,
+        }
+        fields = {k: to_json_value(v) for k, v in fields.items()}
+        write_columns(output_dir / cls.frame_file, columns, fields)
+        return cls(output_dir)
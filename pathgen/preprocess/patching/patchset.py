@@ -1,58 +1,14 @@
 import json
 from pathlib import Path
-from typing import Any, Dict, List
+from typing import Dict, List, Tuple
 
-import cv2
 import pandas as pd
 import numpy as np
 
-from pathgen.data.slides import SlideBase, Region
-from pathgen.data.datasets import Dataset, get_dataset
+from pathgen.data.datasets import get_dataset
 from pathgen.utils.convert import invert
 
-
-class PatchDetails:
-    def __init__(self, ps: "PatchSet", row: pd.Series) -> None:
-        self.ps = ps
-        self.fields = ps.__dict__
-        self.row = row
-
-    def get(self, key: str) -> Any:
-        return self.row[key] if key in self.row else self.fields[f"_{key}"]
-
-    @property
-    def patch_size(self) -> int:
-        return self.get("patch_size")
-
-    @property
-    def level(self) -> int:
-        return self.get("level")
-
-    @property
-    def slide_idx(self) -> int:
-        return self.get("slide_index")
-
-    @property
-    def dataset_name(self) -> str:
-        return self.get("dataset_name")
-
-    @property
-    def dataset(self) -> Dataset:
-        return get_dataset(self.dataset_name)
-
-    @property
-    def region(self) -> Region:
-        return Region.make(self.row["x"], self.row["y"], self.patch_size, self.level)
-
-    @property
-    def label(self) -> str:
-        label_idx = self.row["label"]
-        return self.dataset.labels_by_index[label_idx]
-
-    @property
-    def slide_path(self) -> Path:
-        path = self.dataset.get_slide_path(self.slide_idx)
-        return path
+patchset_fields = ["patch_size", "level", "slide_index", "dataset_name"]
 
 
 class PatchSet:
@@ -79,6 +35,23 @@ class PatchSet:
         else:
             pass  # TODO: get this working with multiple datasets
 
+    def column(self, name: str) -> np.ndarray:
+        """The value of a field for every patch, whether it is a column or a field."""
+        if name in self.df.columns:
+            return self.df[name].to_numpy()
+        return np.full(len(self.df), getattr(self, f"_{name}"))
+
+    def slide_groups(self) -> List[Tuple[Tuple[str, int], np.ndarray]]:
+        """The row positions for each slide, keyed by dataset name and slide index."""
+        keys = pd.DataFrame(
+            {
+                "dataset_name": self.column("dataset_name"),
+                "slide_index": self.column("slide_index"),
+            }
+        )
+        groups = keys.groupby(["dataset_name", "slide_index"]).indices
+        return sorted(groups.items())
+
     # serialisation
     def save(self, path: Path) -> None:
         path.mkdir(parents=True, exist_ok=True)
@@ -99,41 +72,34 @@ class PatchSet:
         return cls(**fields)
 
     # patch outputs
-    def export(self, output_dir: Path) -> None:
-        def sort_patches_by_slide():
-            possible_columns = ["dataset_name", "slide_index"]
-            sort_columns = [c for c in possible_columns if c in self.df.columns]
-            if len(sort_columns) > 0:
-                self.df = self.df.sort_values(sort_columns, ignore_index=True)
-
-        def make_patch_path(p: PatchDetails) -> Path:
-            subdir = output_dir / p.label
-            subdir.mkdir(parents=True, exist_ok=True)
-            filename = f"{p.slide_path.stem}-{p.region.location.x}-{p.region.location.y}-{p.level}.png"
-            return subdir / filename
-
-        def save_patch(region: Region, slide: SlideBase, filepath: Path) -> None:
-            image = slide.read_region(region)
-            opencv_image = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
-            cv2.imwrite(str(filepath), np.array(opencv_image))
-
-        # for each row in the dataframe output the image
-        sort_patches_by_slide()
-        dataset_name, slide_idx, slide = None, None, None
-        print("Exporting patches for: ", end="")
-        for _, row in self.df.iterrows():
-            p = PatchDetails(self, row)
-            if dataset_name != p.dataset_name or slide_idx != p.slide_idx:
-                dataset_name = p.dataset_name
-                slide_idx = p.slide_idx
-                if slide:
-                    slide.close()
-                slide = p.dataset.open_slide(slide_idx)
-                slide.open()
-                print(f"{slide_idx}", end=", ")
-            filepath = make_patch_path(p)
-            save_patch(p.region, slide, filepath)
-        print("Complete.")
+    def export(
+        self,
+        output_dir: Path,
+        codec: str = "png",
+        compression: int = None,
+        num_workers: int = 0,
+        num_threads: int = 4,
+    ) -> None:
+        """Write each patch as an image in a directory for its label, see export_patches."""
+        from pathgen.preprocess.patching.export import export_patches
+
+        export_patches(self, output_dir, codec, compression, num_workers, num_threads)
+
+    def export_shards(
+        self,
+        output_dir: Path,
+        shard_size: int = 4096,
+        codec: str = "png",
+        compression: int = None,
+        num_workers: int = 0,
+        num_threads: int = 4,
+    ) -> None:
+        """Write the patches into tar shards for streaming, see export_shards."""
+        from pathgen.preprocess.patching.export import export_shards
+
+        export_shards(
+            self, output_dir, shard_size, codec, compression, num_workers, num_threads
+        )
 
     def summary(self) -> pd.DataFrame:
         groups = self.df.groupby("label")
@@ -147,30 +113,53 @@ class PatchSet:
 
 
 def combine(patchsets: List[PatchSet]) -> PatchSet:
-    def to_frame(ps: PatchSet) -> pd.DataFrame:
-        frame = ps.df.copy(deep=True)
-        for attr in ["patch_size", "level", "slide_index", "dataset_name"]:
-            value = getattr(ps, f"_{attr}", None)
-            if attr not in frame.columns:
-                frame[attr] = value
-        return frame
-
     # create one big data frame with all the patch data in it
-    frames = [to_frame(ps) for ps in patchsets]
+    frames = [ps.df for ps in patchsets]
     combined_df = pd.concat(frames, ignore_index=True)
+    lengths = [len(frame) for frame in frames]
+    fields = [
+        {k: getattr(ps, f"_{k}", None) for k in patchset_fields} for ps in patchsets
+    ]
+    return combine_frame(combined_df, lengths, fields)
+
 
-    # optimise
-    def is_unique(s):
-        a = s.to_numpy()
-        return (a[0] == a).all()
+def combine_frame(df: pd.DataFrame, lengths: List[int], fields: List[Dict]) -> PatchSet:
+    """ Make one patchset from the rows of several slides, one after another in a frame.
 
-    cols = ["patch_size", "level", "slide_index", "dataset_name"]
+    A field that is the same for every patch is kept as a field, otherwise it is
+    repeated into a column for the rows of each slide. The frame is not copied.
+
+    Args:
+        df (pd.DataFrame): The rows of all the slides.
+        lengths (List[int]): The number of rows of each slide.
+        fields (List[Dict]): The patchset fields of each slide.
+
+    Returns:
+        PatchSet: The combined patchset.
+    """
+    df = df.copy(deep=False)  # so that adding and removing columns leaves df alone
     args = {}
-    for col in cols:
-        if is_unique(combined_df[col]):
-            series = combined_df[col]
-            args[col] = series[0]
-            combined_df.pop(col)
-    args["df"] = combined_df
+    for attr in patchset_fields:
+        values = [f.get(attr) for f in fields]
+        if attr in df.columns:
+            column = df[attr]
+            if column.isna().any():
+                # slides that had the field rather than the column
+                column = column.where(column.notna(), np.repeat(values, lengths))
+        elif all(v == values[0] for v in values):
+            args[attr] = values[0] if values else None
+            continue
+        else:
+            column = np.repeat(values, lengths)
+
+        # optimise
+        a = np.asarray(column)
+        if len(a) > 0 and (a[0] == a).all():
+            args[attr] = a[0]
+            if attr in df.columns:
+                df.pop(attr)
+        else:
+            df[attr] = column
+    args["df"] = df
 
     return PatchSet(**args)
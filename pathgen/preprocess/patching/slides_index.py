@@ -1,41 +1,235 @@
 from pathgen.data.datasets.dataset import Dataset
-from typing import List, Sequence
+from typing import Dict, List, Sequence, Tuple
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 
-from pathgen.preprocess.patching.patchset import PatchSet
+from pathgen.data.datasets import get_dataset
+from pathgen.preprocess.patching.patchset import (
+    PatchSet,
+    combine_frame,
+    patchset_fields,
+)
+from pathgen.utils.convert import invert
+from pathgen.utils.columnar import read_columns, write_columns
+from pathgen.utils.json import to_json_value
+
+# the smallest dtypes that hold the usual values of the patch columns
+compact_dtypes = {
+    "x": np.int32,
+    "y": np.int32,
+    "label": np.uint8,
+    "level": np.uint8,
+    "patch_size": np.int32,
+    "slide_index": np.uint16,
+}
 
 
 class SlidesIndex(Sequence):
     def __init__(self, patches: List[PatchSet]) -> None:
-        self.patches = patches
+        """ The patches of a number of slides, in a single table.
+
+        The rows of every slide are stored one after another in one frame, with the
+        start and stop row of each slide and its patchset fields. Selecting slides
+        only selects their row ranges, so it does not copy the patches.
+
+        The slides are read only views. Getting a slide, or the patches property,
+        makes a new PatchSet each time whose df is the slide's rows of the table,
+        indexed by their row in the table rather than from 0. Assigning a new df to
+        it, or changing its df in place, does not change the index, so build a new
+        SlidesIndex from the changed patch sets instead.
+
+        Args:
+            patches (List[PatchSet]): The patches of each slide.
+        """
+        frames = [ps.df for ps in patches]
+        table = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+        offsets = np.cumsum([0] + [len(f) for f in frames]).astype(np.int64)
+        fields = [{k: getattr(ps, f"_{k}") for k in patchset_fields} for ps in patches]
+        self._set_table(table, offsets[:-1], offsets[1:], fields)
+
+    @classmethod
+    def from_table(
+        cls,
+        table: pd.DataFrame,
+        starts: np.ndarray,
+        stops: np.ndarray,
+        fields: List[Dict],
+    ) -> "SlidesIndex":
+        """An index of the rows of a table from start to stop for each slide."""
+        index = cls.__new__(cls)
+        index._set_table(table, starts, stops, fields)
+        return index
+
+    def _set_table(
+        self,
+        table: pd.DataFrame,
+        starts: np.ndarray,
+        stops: np.ndarray,
+        fields: List[Dict],
+    ) -> None:
+        self.table = table
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.stops = np.asarray(stops, dtype=np.int64)
+        self.fields = list(fields)
 
     def __len__(self):
-        return len(self.patches)
+        return len(self.fields)
 
     def __getitem__(self, idx):
-        return self.patches[idx]
+        if isinstance(idx, slice):
+            return self.select(range(len(self))[idx])
+        start, stop = self.starts[idx], self.stops[idx]
+        return PatchSet(self.table.iloc[start:stop], **self.fields[idx])
+
+    @property
+    def patches(self) -> List[PatchSet]:
+        """A new read only view of each slide, see the class docstring."""
+        return [self[idx] for idx in range(len(self))]
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return self.stops - self.starts
+
+    def rows(self) -> pd.DataFrame:
+        """The rows of every slide in order, which is the table itself if possible."""
+        starts, stops = self.starts, self.stops
+        whole = len(self) > 0 and starts[0] == 0 and stops[-1] == len(self.table)
+        if whole and np.array_equal(starts[1:], stops[:-1]):
+            return self.table
+        lengths = self.lengths
+        firsts = np.cumsum(lengths) - lengths
+        positions = np.arange(lengths.sum()) + np.repeat(starts - firsts, lengths)
+        return self.table.take(positions).reset_index(drop=True)
+
+    def combine(self) -> PatchSet:
+        """All the patches in one patchset, with a column for fields that differ."""
+        return combine_frame(self.rows(), self.lengths, self.fields)
 
     def summary(self) -> pd.DataFrame:
-        summaries = [s.summary() for s in self.patches]
-        rtn = pd.concat(summaries)
-        rtn = rtn.reset_index()
-        rtn = rtn.drop("index", axis=1)
+        """The number of patches with each label, with a row for each slide."""
+        slides = np.repeat(np.arange(len(self)), self.lengths)
+        keys = pd.DataFrame({"slide": slides, "label": self.rows()["label"]})
+        counts = keys.groupby(["slide", "label"]).size().unstack(fill_value=0)
+        counts = counts.reindex(range(len(self)), fill_value=0)
+
+        # the label names depend on the data set of each slide
+        names = pd.Series([f["dataset_name"] for f in self.fields])
+        frames = []
+        for name, positions in names.groupby(names, sort=False).indices.items():
+            labels = get_dataset(name).labels
+            frame = counts.iloc[positions].rename(columns=invert(labels))
+            frames.append(frame.reindex(columns=list(labels.keys()), fill_value=0))
+        rtn = pd.concat(frames).sort_index() if frames else pd.DataFrame()
+        rtn = rtn.reset_index(drop=True)
+        rtn.columns.name = "label"
         return rtn
 
     def save(self, output_dir: Path) -> None:
-        for idx, patchset in enumerate(self.patches):
+        for idx, patchset in enumerate(self):
             patchset.save(output_dir / f"{idx}")
 
     @classmethod
     def load(cls, input_dir: Path) -> "SlidesIndex":
+        """Load an index saved by save, or a columns file saved by save_columns."""
+        if input_dir.is_file():
+            return cls.load_columns(input_dir)
         subdirs = [x for x in input_dir.iterdir() if x.is_dir()]
-        subdirs = sorted(subdirs)  # might not be required
+        # the directories are named by position, so "10" comes after "2"
+        subdirs = sorted(subdirs, key=lambda d: (len(d.name), d.name))
         patches = [PatchSet.load(subdir) for subdir in subdirs]
         return cls(patches)
 
+    def save_columns(self, path: Path) -> None:
+        """ Save the whole index in a single binary columns file.
+
+        The frames of every slide are stored one after another in compact dtypes, with
+        the offset of each slide's rows and its fields in a per slide table. Text
+        columns such as dataset_name are stored as categories.
+
+        Args:
+            path (Path): The file to write.
+        """
+        columns, categories = compact_columns(self.rows())
+        offsets = np.cumsum(np.concatenate([[0], self.lengths])).astype(np.int64)
+        slides = [
+            {k: to_json_value(f[k]) for k in patchset_fields} for f in self.fields
+        ]
+        attrs = {"categories": categories, "slides": slides}
+        write_columns(path, {**columns, "_offsets": offsets}, attrs)
+
+    @classmethod
+    def load_columns(
+        cls, path: Path, columns: List[str] = None, mmap: bool = False
+    ) -> "SlidesIndex":
+        """ Load an index saved by save_columns.
+
+        Args:
+            path (Path): The file to read.
+            columns (List[str], optional): Only load these columns of the frames.
+                Defaults to None, all of them.
+            mmap (bool, optional): Memory map the columns rather than reading them.
+                Defaults to False.
+
+        Returns:
+            SlidesIndex: The index.
+        """
+        names = None if columns is None else list(columns) + ["_offsets"]
+        arrays, attrs = read_columns(path, names, mmap)
+        offsets = arrays.pop("_offsets")
+        table = expand_columns(arrays, attrs["categories"])
+        return cls.from_table(table, offsets[:-1], offsets[1:], attrs["slides"])
+
     def select(self, indices: List[int]) -> "SlidesIndex":
-        patchsets = [self[i] for i in indices]
-        return SlidesIndex(patchsets)
+        indices = np.asarray(indices, dtype=np.int64)
+        fields = [self.fields[i] for i in indices]
+        return self.from_table(
+            self.table, self.starts[indices], self.stops[indices], fields
+        )
+
+
+def compact_columns(df: pd.DataFrame) -> Tuple[Dict[str, np.ndarray], Dict[str, List]]:
+    """ Convert a frame to arrays for write_columns, with the smallest dtypes that fit.
+
+    Args:
+        df (pd.DataFrame): The frame to convert.
+
+    Returns:
+        Tuple[Dict[str, np.ndarray], Dict[str, List]]: The arrays and the categories
+            of the columns that are stored as category codes.
+    """
+    columns, categories = {}, {}
+    for name, series in df.items():
+        values = series.to_numpy()
+        if values.dtype.hasobject or isinstance(series.dtype, pd.CategoricalDtype):
+            codes, uniques = pd.factorize(series)
+            dtype = np.uint8 if len(uniques) <= 2 ** 8 else np.int32
+            columns[name] = codes.astype(dtype)
+            categories[name] = [to_json_value(v) for v in uniques]
+            continue
+        dtype = compact_dtypes.get(name)
+        if dtype is not None and len(values) > 0:
+            info = np.iinfo(dtype)
+            if values.min() < info.min or values.max() > info.max:
+                dtype = None
+        columns[name] = values if dtype is None else values.astype(dtype)
+    return columns, categories
+
+
+def expand_columns(
+    columns: Dict[str, np.ndarray], categories: Dict[str, List]
+) -> pd.DataFrame:
+    """The frame for arrays from compact_columns, without copying the numeric columns."""
+    df = {}
+    for name, values in columns.items():
+        if name in categories:
+            df[name] = pd.Categorical.from_codes(values, categories[name])
+        else:
+            df[name] = values
+    return pd.DataFrame(df, copy=False)
+
 
+def convert_to_columns(input_dir: Path, output_path: Path) -> None:
+    """Convert an index saved by SlidesIndex.save as csv files to a columns file."""
+    SlidesIndex.load(input_dir).save_columns(output_path)
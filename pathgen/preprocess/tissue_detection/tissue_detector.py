@@ -1,8 +1,14 @@
 from abc import ABCMeta, abstractmethod
+from tempfile import TemporaryFile
+from typing import Tuple
 
+import cv2
 import numpy as np
 from skimage.color import rgb2hsv
 from skimage.filters import threshold_otsu
+from skimage.util import img_as_ubyte
+
+from pathgen.data.slides import SlideBase
 
 
 class TissueDetector(metaclass=ABCMeta):
@@ -10,6 +16,21 @@ class TissueDetector(metaclass=ABCMeta):
     def __call__(self, image: np.ndarray) -> np.array:
         raise NotImplementedError
 
+    def detect_slide(self, slide: SlideBase, level: int) -> np.ndarray:
+        """ Detect the tissue in a slide at a level.
+
+        The default reads the whole level with get_thumbnail, detectors that can
+        work on tiles should override this.
+
+        Args:
+            slide: The open slide.
+            level: The level to detect tissue at.
+
+        Returns:
+            An ndarray of booleans with the shape of the level, True means foreground.
+        """
+        return self(slide.get_thumbnail(level))
+
 
 class TissueDetectorOTSU(TissueDetector):
     def __call__(self, image: np.ndarray) -> np.ndarray:
@@ -42,3 +63,189 @@ class TissueDetectorOTSU(TissueDetector):
         np_mask = np.logical_or(mask_h, mask_s)
         return np_mask
 
+
+def count_colours(image: np.ndarray, counts: np.ndarray = None) -> np.ndarray:
+    """ Count the pixels of each colour in a uint8 r,g,b image.
+
+    Args:
+        image: The image.
+        counts: The counts to add to, for example from the other tiles of an image.
+            Defaults to None, which starts from zero.
+
+    Returns:
+        The count of each colour, indexed by its r * 65536 + g * 256 + b.
+    """
+    packed = image[:, :, 0].astype(np.int32) << 16
+    packed |= image[:, :, 1].astype(np.int32) << 8
+    packed |= image[:, :, 2]
+    image_counts = np.bincount(packed.ravel(), minlength=1 << 24)
+    if counts is None:
+        return image_counts
+    counts += image_counts
+    return counts
+
+
+def weighted_otsu(values: np.ndarray, weights: np.ndarray, nbins: int = 256) -> float:
+    """ Otsu's threshold of values that each occur weights times, as skimage finds it.
+
+    threshold_otsu puts the values into nbins equal bins from the smallest to the
+    largest value and returns the centre of the best bin. np.histogram bins the
+    values with weights the same way as it would the repeated values, so the
+    threshold is exactly the one threshold_otsu finds for the whole image.
+    """
+    if np.all(values == values[0]):
+        return float(values[0])
+    counts, edges = np.histogram(values, nbins, weights=weights)
+    centres = (edges[:-1] + edges[1:]) / 2.0
+    return float(threshold_otsu(hist=(counts, centres)))
+
+
+def hsv_thresholds(counts: np.ndarray) -> Tuple[float, float]:
+    """ The hue and saturation thresholds TissueDetectorOTSU finds for an image.
+
+    Only the distinct colours are converted to hsv, with skimage, so the hue and
+    saturation values are exactly the ones skimage finds for each pixel.
+    """
+    colours = np.flatnonzero(counts)
+    weights = counts[colours]
+    rgb = np.stack([colours >> 16, colours >> 8, colours], axis=-1)
+    hsv = rgb2hsv((rgb & 255).astype(np.uint8)[np.newaxis])[0]
+    return weighted_otsu(hsv[:, 0], weights), weighted_otsu(hsv[:, 1], weights)
+
+
+def saturation_table(threshold: float) -> np.ndarray:
+    """ Which saturations are above a threshold, by the max and min channel of a pixel.
+
+    The saturation only depends on the largest and smallest channel, so this is
+    indexed by max * 256 + min and is found with skimage for every pair, to give
+    exactly the same comparison as TissueDetectorOTSU.
+    """
+    levels = np.arange(256, dtype=np.uint8)
+    high, low = np.meshgrid(levels, levels, indexing="ij")
+    saturation = rgb2hsv(np.stack([high, low, low], axis=-1))[:, :, 1]
+    return (saturation > threshold).ravel()
+
+
+class TissueDetectorOTSUFast(TissueDetector):
+    def __init__(self, chunk_rows: int = 1024, threshold_hue: bool = False) -> None:
+        """ An integer version of TissueDetectorOTSU for uint8 images.
+
+        Rather than converting the whole image to floating point hsv, the pixels of
+        each colour are counted a chunk of rows at a time and only the colours that
+        are present are converted to find the Otsu thresholds, then the saturation of
+        each pixel is compared with a table indexed by its largest and smallest
+        channel. This gives exactly the same masks as TissueDetectorOTSU, using a
+        fixed 128MB table of counts rather than 24 bytes for every pixel.
+
+        TissueDetectorOTSU compares the saturation channel with both the hue and the
+        saturation thresholds. That is kept by default so the two give the same
+        masks, set threshold_hue to compare the hue channel with its threshold. The
+        hue is then OpenCV's 8 bit hue, so pixels within a step of the threshold may
+        differ from a floating point hue.
+
+        Args:
+            chunk_rows: The number of rows to convert at once. Defaults to 1024.
+            threshold_hue: Threshold the hue rather than the saturation channel with
+                the hue threshold. Defaults to False.
+        """
+        self.chunk_rows = chunk_rows
+        self.threshold_hue = threshold_hue
+
+    def __call__(self, image: np.ndarray) -> np.ndarray:
+        """ Detect the tissue in an r,g,b image, see TissueDetectorOTSU.
+
+        Args:
+            image: A scaled down WSI image. Must be r,g,b.
+
+        Returns:
+            An ndarray of booleans with the same dimensions as the input image
+            True means foreground, False means background
+        """
+        image = img_as_ubyte(np.asarray(image)[:, :, :3])
+        chunks = [
+            slice(top, top + self.chunk_rows)
+            for top in range(0, image.shape[0], self.chunk_rows)
+        ]
+
+        # count the colours in chunks of rows, then threshold each chunk
+        counts = None
+        for rows in chunks:
+            counts = count_colours(image[rows], counts)
+        thresholds = hsv_thresholds(counts)
+        np_mask = np.empty(image.shape[:2], dtype=bool)
+        for rows in chunks:
+            self._threshold(image[rows], thresholds, np_mask[rows])
+        return np_mask
+
+    def _threshold(
+        self, image: np.ndarray, thresholds: Tuple[float, float], out: np.ndarray
+    ) -> None:
+        thresh_h, thresh_s = thresholds
+        if not self.threshold_hue:
+            # a saturation above either threshold is foreground, as in skimage
+            thresh_s = min(thresh_h, thresh_s)
+        red, green, blue = image[:, :, 0], image[:, :, 1], image[:, :, 2]
+        index = np.maximum(np.maximum(red, green), blue).astype(np.uint16) << 8
+        index |= np.minimum(np.minimum(red, green), blue)
+        np.take(saturation_table(thresh_s), index, out=out)
+        if self.threshold_hue:
+            # the 8 bit hue goes from 0 to 256 rather than 0 to 1
+            hue = cv2.cvtColor(image, cv2.COLOR_RGB2HSV_FULL)[:, :, 0]
+            out |= hue > thresh_h * 256
+
+
+class TissueDetectorOTSUTiled(TissueDetectorOTSUFast):
+    def __init__(
+        self, tile_size: int = 2048, threshold_hue: bool = False, memmap: bool = False
+    ) -> None:
+        """ A two pass version of TissueDetectorOTSUFast that streams tiles from a slide.
+
+        Otsu's method only needs the histograms of the whole image, so detect_slide
+        reads the slide a tile at a time to count the colours, then
+        reads the tiles again to threshold them into the mask. Only the mask and a
+        tile are held in memory rather than the whole thumbnail, or only a tile if the
+        mask is memory mapped, so tissue can be detected at much higher resolutions.
+
+        Args:
+            tile_size: The width and height of the tiles read from the slide.
+                Defaults to 2048.
+            threshold_hue: See TissueDetectorOTSUFast. Defaults to False.
+            memmap: Write the mask to a memory mapped temporary file. Defaults to False.
+        """
+        super().__init__(chunk_rows=tile_size, threshold_hue=threshold_hue)
+        self.tile_size = tile_size
+        self.memmap = memmap
+
+    def detect_slide(
+        self, slide: SlideBase, level: int, out: np.ndarray = None
+    ) -> np.ndarray:
+        """ Detect the tissue in a slide at a level without reading the whole level.
+
+        Args:
+            slide: The open slide.
+            level: The level to detect tissue at, which can be deeper than the pyramid.
+            out: A boolean array with the shape of the level to write the mask into.
+                Defaults to None, which allocates one.
+
+        Returns:
+            The mask, True means foreground, False means background.
+        """
+        # the first pass counts the colours
+        counts = None
+        for _, tile in slide.iter_thumbnail_tiles(level, self.tile_size):
+            counts = count_colours(tile, counts)
+        thresholds = hsv_thresholds(counts)
+
+        # the second pass thresholds each tile into the mask
+        if out is None:
+            shape = slide.thumbnail_size(level).as_shape()
+            if self.memmap:
+                out = np.memmap(TemporaryFile(), dtype=bool, mode="w+", shape=shape)
+            else:
+                out = np.empty(shape, dtype=bool)
+        for (left, top), tile in slide.iter_thumbnail_tiles(level, self.tile_size):
+            height, width = tile.shape[:2]
+            self._threshold(
+                tile, thresholds, out[top : top + height, left : left + width]
+            )
+        return out
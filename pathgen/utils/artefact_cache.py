@@ -0,0 +1,86 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import Any, Callable, Dict, Optional
+
+import numpy as np
+
+
+class ArtefactCache:
+    def __init__(self, root: Path, max_bytes: int = 10 * 2 ** 30) -> None:
+        """ A content addressed cache of arrays on disk, for intermediate results such as
+        tissue masks and rendered labels images that are slow to recompute.
+
+        Each array is stored compressed in a file named by the hash of its key, so any
+        change to the inputs in the key gives a new entry rather than a stale one. When
+        the files use more than max_bytes, the least recently used are deleted.
+
+        Args:
+            root (Path): The directory to store the arrays in.
+            max_bytes (int, optional): The most disk space to use. Defaults to 10GiB.
+        """
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(parts: Dict[str, Any]) -> str:
+        """A hash of the parts, which must be json serialisable or have a stable str."""
+        text = json.dumps(parts, sort_keys=True, default=str)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def path(self, key: str) -> Path:
+        return self.root / f"{key}.npz"
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        path = self.path(key)
+        try:
+            with np.load(path) as data:
+                array = data["array"]
+            os.utime(path)  # mark as recently used for eviction
+            return array
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def put(self, key: str, array: np.ndarray) -> None:
+        # write to a temporary file and rename so readers never see a partial file
+        with NamedTemporaryFile(dir=self.root, suffix=".tmp", delete=False) as f:
+            np.savez_compressed(f, array=array)
+        os.replace(f.name, self.path(key))
+        self.evict()
+
+    def fetch(
+        self, parts: Dict[str, Any], create: Callable[[], np.ndarray]
+    ) -> np.ndarray:
+        """Get the array for the parts from the cache, or create and cache it."""
+        key = self.key(parts)
+        array = self.get(key)
+        if array is None:
+            array = create()
+            self.put(key, array)
+        return array
+
+    def evict(self) -> None:
+        """Delete the least recently used arrays until the cache is under max_bytes."""
+        entries = []
+        for path in self.root.glob("*.npz"):
+            try:
+                stat = path.stat()
+            except OSError:  # deleted by another process
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self) -> None:
+        for path in self.root.glob("*.npz"):
+            path.unlink()
@@ -0,0 +1,92 @@
+import json
+import struct
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+# file layout: magic, header length, json header, then each column's raw bytes
+# starting on an ALIGNMENT byte boundary so they can be memory mapped directly
+MAGIC = b"PGCOLS01"
+ALIGNMENT = 64
+_prefix = struct.Struct("<8sQ")
+
+
+def _align(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_columns(
+    path: Path, columns: Dict[str, np.ndarray], attrs: Dict[str, Any] = None
+) -> None:
+    """ Write a set of named arrays and some json attributes into a single binary file.
+
+    The arrays can be any shape but must have a fixed size dtype, strings should be
+    converted to fixed width unicode (e.g. np.asarray(values, dtype=str)).
+
+    Args:
+        path: The file to write.
+        columns: The arrays to write keyed by name.
+        attrs: Any json serialisable data to store with the arrays.
+    """
+    arrays = {name: np.ascontiguousarray(a) for name, a in columns.items()}
+    layout, offset = {}, 0
+    for name, a in arrays.items():
+        if a.dtype.hasobject:
+            raise ValueError(f"Column {name} has dtype object which can not be stored.")
+        layout[name] = {"dtype": a.dtype.str, "shape": a.shape, "offset": offset}
+        offset = _align(offset + a.nbytes)
+    header = json.dumps({"attrs": attrs or {}, "columns": layout}).encode()
+
+    data_start = _align(_prefix.size + len(header))
+    with open(path, "wb") as f:
+        f.write(_prefix.pack(MAGIC, len(header)))
+        f.write(header)
+        for name, a in arrays.items():
+            f.seek(data_start + layout[name]["offset"])
+            f.write(a.tobytes())
+        f.truncate(data_start + offset)
+
+
+def read_header(path: Path) -> Tuple[Dict[str, Any], int]:
+    """Returns the json header and the file offset at which the column data starts."""
+    with open(path, "rb") as f:
+        magic, length = _prefix.unpack(f.read(_prefix.size))
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a columns file.")
+        header = json.loads(f.read(length).decode())
+    return header, _align(_prefix.size + length)
+
+
+def read_columns(
+    path: Path, names: List[str] = None, mmap: bool = False
+) -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+    """ Read arrays written by write_columns.
+
+    Args:
+        path: The file to read.
+        names: Only read these columns. Defaults to all the columns.
+        mmap: Return read only memory mapped arrays rather than reading them into memory.
+
+    Returns:
+        The arrays keyed by name and the attributes stored with them.
+    """
+    header, data_start = read_header(path)
+    layout = header["columns"]
+    names = list(layout.keys()) if names is None else names
+    columns = {}
+    with open(path, "rb") as f:
+        for name in names:
+            dtype = np.dtype(layout[name]["dtype"])
+            shape = tuple(layout[name]["shape"])
+            offset = data_start + layout[name]["offset"]
+            count = int(np.prod(shape))
+            if mmap and count > 0:
+                columns[name] = np.memmap(
+                    path, dtype=dtype, mode="r", offset=offset, shape=shape
+                )
+            else:
+                f.seek(offset)
+                a = np.fromfile(f, dtype=dtype, count=count)
+                columns[name] = a.reshape(shape)
+    return columns, header["attrs"]
@@ -0,0 +1,67 @@
+from collections import deque
+from concurrent.futures import Executor, FIRST_COMPLETED, wait
+from typing import Callable, Iterable, Iterator, List, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def bounded_map(
+    executor: Executor, fn: Callable[[T], R], items: Iterable[T], max_in_flight: int
+) -> List[R]:
+    """ Map fn over items using executor, with at most max_in_flight calls pending at once.
+
+    Unlike Executor.map this does not submit every item up front, so a single call
+    can be limited to a share of a larger pool. The results are returned in the
+    same order as the items.
+
+    Args:
+        executor: The executor to submit the calls to.
+        fn: The function to call on each item.
+        items: The items to map over.
+        max_in_flight: The maximum number of calls submitted but not yet complete.
+
+    Returns:
+        A list with the result of fn for each item, in input order.
+    """
+    max_in_flight = max(1, max_in_flight)
+    results = []
+    pending = {}
+    for idx, item in enumerate(items):
+        results.append(None)
+        if len(pending) >= max_in_flight:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[pending.pop(future)] = future.result()
+        pending[executor.submit(fn, item)] = idx
+    for future, idx in pending.items():
+        results[idx] = future.result()
+    return results
+
+
+def bounded_imap(
+    executor: Executor, fn: Callable[[T], R], items: Iterable[T], max_in_flight: int
+) -> Iterator[R]:
+    """ Lazily map fn over items using executor, yielding each result in order.
+
+    At most max_in_flight calls are submitted ahead of the result being waited for,
+    so the results can be used as soon as they are ready and only a window of them
+    is held at once, however many items there are.
+
+    Args:
+        executor: The executor to submit the calls to.
+        fn: The function to call on each item.
+        items: The items to map over.
+        max_in_flight: The maximum number of calls submitted but not yet yielded.
+
+    Yields:
+        The result of fn for each item, in input order.
+    """
+    max_in_flight = max(1, max_in_flight)
+    pending = deque()
+    for item in items:
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().result()
+        pending.append(executor.submit(fn, item))
+    while pending:
+        yield pending.popleft().result()
@@ -16,7 +16,8 @@ def pool2d(A, kernel_size, stride, padding, pool_mode="max"):
         pool_mode: string, 'max' or 'avg'
     """
     # Padding
-    A = np.pad(A, padding, mode="constant")
+    if padding > 0:
+        A = np.pad(A, padding, mode="constant")
 
     # Window view of A
     output_shape = (
@@ -29,11 +30,62 @@ def pool2d(A, kernel_size, stride, padding, pool_mode="max"):
         shape=output_shape + kernel_size,
         strides=(stride * A.strides[0], stride * A.strides[1]) + A.strides,
     )
-    A_w = A_w.reshape(-1, *kernel_size)
 
-    # Return the result of pooling
+    # Return the result of pooling, reducing the window view directly as reshaping
+    # it would copy every window
     if pool_mode == "max":
-        return A_w.max(axis=(1, 2)).reshape(output_shape)
+        return A_w.max(axis=(2, 3))
     elif pool_mode == "avg":
-        return A_w.mean(axis=(1, 2)).reshape(output_shape)
+        return A_w.mean(axis=(2, 3))
 
+
+def pool2d_fractions(
+    A: np.ndarray,
+    kernel_size: int,
+    stride: int,
+    num_labels: int = None,
+    band_rows: int = 64,
+) -> np.ndarray:
+    """ The fraction of each window that has each label, for windows on a regular grid.
+
+    The windows are the same as pool2d with no padding. The sums are found from the
+    cumulative sums of each label along the columns then the rows, so the cost does
+    not depend on how much the windows overlap and the windows are never copied.
+    The image is processed a band of output rows at a time to bound the memory used.
+
+    Args:
+        A: A 2D array of non negative integer labels.
+        kernel_size: The width and height of the windows.
+        stride: The distance between the windows.
+        num_labels: The number of labels, defaults to the largest label plus one.
+        band_rows: The number of rows of windows to compute at once. Defaults to 64.
+
+    Returns:
+        A float32 array of shape (rows, cols, num_labels).
+    """
+    if num_labels is None:
+        num_labels = int(A.max()) + 1 if A.size else 1
+    num_rows = (A.shape[0] - kernel_size) // stride + 1
+    num_cols = (A.shape[1] - kernel_size) // stride + 1
+    fractions = np.zeros((max(num_rows, 0), max(num_cols, 0), num_labels), np.float32)
+    if num_rows <= 0 or num_cols <= 0:
+        return fractions
+
+    lefts = np.arange(num_cols) * stride
+    for first in range(0, num_rows, band_rows):
+        last = min(first + band_rows, num_rows)
+        band = A[first * stride : (last - 1) * stride + kernel_size]
+        tops = np.arange(last - first) * stride
+        for label in range(num_labels):
+            # sum each window's columns, then its rows, from cumulative sums
+            column_sums = np.zeros((band.shape[0], band.shape[1] + 1), np.int32)
+            np.cumsum(band == label, axis=1, out=column_sums[:, 1:])
+            row_sums = np.zeros((band.shape[0] + 1, num_cols), np.int64)
+            np.cumsum(
+                column_sums[:, lefts + kernel_size] - column_sums[:, lefts],
+                axis=0,
+                out=row_sums[1:],
+            )
+            counts = row_sums[tops + kernel_size] - row_sums[tops]
+            fractions[first:last, :, label] = counts / (kernel_size * kernel_size)
+    return fractions
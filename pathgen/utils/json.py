@@ -1,5 +1,7 @@
 import inspect
 
+import numpy as np
+
 
 def to_json(an_object, exclude=[]):
     fields = an_object.__dict__
@@ -13,3 +15,19 @@ def from_json(json_object):
         kargs_dict = json_object["fields"]
         return eval(type_name)(**kargs_dict)
     return json_object
+
+
+def to_json_value(value):
+    # numpy scalars (e.g. from a data frame) are not json serialisable
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def to_json_params(an_object):
+    """A json description of an object's type and parameters, recursing into its fields."""
+    if isinstance(an_object, (list, tuple)):
+        return [to_json_params(v) for v in an_object]
+    if isinstance(an_object, dict):
+        return {str(k): to_json_params(v) for k, v in an_object.items()}
+    if hasattr(an_object, "__dict__") and not inspect.isroutine(an_object):
+        return {"type": type(an_object).__qualname__, **to_json_params(vars(an_object))}
+    return to_json_value(an_object)
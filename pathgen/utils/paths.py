@@ -1,5 +1,19 @@
 from pathlib import Path
+from typing import Dict, Optional
 
 
 def project_root() -> Path:
     return Path(__file__).parent.parent.parent
+
+
+def file_fingerprint(path: Path) -> Optional[Dict]:
+    """The resolved path, modification time and size of a file, or None if it does not exist."""
+    path = Path(path)
+    if not path.is_file():
+        return None
+    stat = path.stat()
+    return {
+        "path": str(path.resolve()),
+        "mtime_ns": stat.st_mtime_ns,
+        "size": stat.st_size,
+    }
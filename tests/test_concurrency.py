@@ -0,0 +1,19 @@
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from pathgen.utils.concurrency import bounded_imap
+
+
+def test_bounded_imap_is_lazy_and_ordered():
+    started = []
+
+    def square(x):
+        started.append(x)
+        return x * x
+
+    with ThreadPoolExecutor(4) as executor:
+        results = bounded_imap(executor, square, range(100), 3)
+        assert list(islice(results, 5)) == [x * x for x in range(5)]
+        # only a window of calls is submitted ahead of the results taken
+        assert len(started) <= 5 + 3
+        assert list(results) == [x * x for x in range(5, 100)]
@@ -0,0 +1,117 @@
+import json
+import os
+
+import pytest
+
+from pathgen.data.annotations.annotation import AnnotationSet
+from pathgen.data.datasets.registry import register_dataset
+from pathgen.data.datasets.synthetic import make_synthetic
+from pathgen.preprocess.patching import (
+    GridPatchFinder,
+    index_slide,
+    make_index,
+    merge_index,
+    read_manifest,
+)
+from pathgen.preprocess.tissue_detection import TissueDetectorOTSUFast
+from pathgen.utils.artefact_cache import ArtefactCache
+from pathgen.utils.geometry import Size
+
+
+class CrashingDetector(TissueDetectorOTSUFast):
+    """Kills the process that detects the tissue in one slide, like a native crash."""
+
+    def __init__(self, crash_on: str) -> None:
+        super().__init__()
+        self.crash_on = crash_on
+
+    def detect_slide(self, slide, level):
+        if slide.path.stem == self.crash_on:
+            os._exit(3)
+        return super().detect_slide(slide, level)
+
+
+def test_worker_crash_fails_only_its_slide(tmp_path):
+    dataset = make_synthetic("crash", 2, 1, size=Size(2048, 1536), num_levels=4)
+    finder = GridPatchFinder(3, 0, 64, 64)
+    detector = CrashingDetector("tumor_002")
+    index = make_index(dataset, detector, finder, num_workers=2, output_dir=tmp_path)
+
+    assert [ps._slide_index for ps in index] == [0, 2]
+    manifest = read_manifest(tmp_path / "1")
+    assert manifest["error"] == "worker exited with code 3"
+
+
+def test_merge_index_checks_the_shards(tmp_path, capsys):
+    dataset = make_synthetic("merge", 2, 1, size=Size(2048, 1536), num_levels=4)
+    finder = GridPatchFinder(3, 0, 64, 64)
+    detector = TissueDetectorOTSUFast()
+    shard_dirs = [tmp_path / "a", tmp_path / "b"]
+    for shard_dir, indices in zip(shard_dirs, [[1], [0]]):
+        make_index(dataset, detector, finder, output_dir=shard_dir, indices=indices)
+
+    # the last slide is missing from both shards
+    index = merge_index(shard_dirs)
+    assert [ps._slide_index for ps in index] == [0, 1]
+    assert "missing 1 slides [2]" in capsys.readouterr().out
+
+    # a shard of a different version of the data set is not merged
+    manifest = read_manifest(shard_dirs[1] / "0")
+    with open(shard_dirs[1] / "0" / "manifest.json", "w") as f:
+        json.dump({**manifest, "num_slides": 4}, f)
+    with pytest.raises(ValueError):
+        merge_index(shard_dirs)
+
+
+def test_labels_cache_key_includes_render_settings(tmp_path):
+    dataset = make_synthetic("render", 1, 0, size=Size(2048, 1536), num_levels=4)
+    register_dataset(dataset)
+    finder = GridPatchFinder(3, 0, 64, 64)
+    detector = TissueDetectorOTSUFast()
+    cache = ArtefactCache(tmp_path)
+    for tile_size in [4096, 4096, 64]:
+        index_slide(0, dataset, detector, finder, tile_size, cache, 0)
+    # one tissue mask and a labels image for each tile size
+    assert len(list(tmp_path.glob("*.npz"))) == 3
+
+
+def test_adding_a_slide_only_indexes_the_new_slide(tmp_path, capsys):
+    finder = GridPatchFinder(3, 0, 64, 64)
+    detector = TissueDetectorOTSUFast()
+    small = make_synthetic("grow", 2, 0, size=Size(2048, 1536), num_levels=4)
+    make_index(small, detector, finder, output_dir=tmp_path)
+    capsys.readouterr()
+
+    large = make_synthetic("grow", 3, 0, size=Size(2048, 1536), num_levels=4)
+    index = make_index(large, detector, finder, output_dir=tmp_path)
+    out = capsys.readouterr().out
+    assert "indexing tumor_003" in out
+    assert "indexing tumor_001" not in out and "indexing tumor_002" not in out
+    assert len(index) == 3
+    # the slides that were up to date are merged with the new one
+    assert len(merge_index([tmp_path])) == 3
+
+
+def test_max_memory_needs_workers():
+    dataset = make_synthetic("serial", 1, 0, size=Size(2048, 1536), num_levels=4)
+    finder = GridPatchFinder(3, 0, 64, 64)
+    with pytest.raises(ValueError):
+        make_index(dataset, TissueDetectorOTSUFast(), finder, max_memory=2 ** 30)
+
+
+def test_labels_are_rendered_whole_unless_too_large(monkeypatch):
+    dataset = make_synthetic("whole", 1, 0, size=Size(2048, 1536), num_levels=4)
+    register_dataset(dataset)
+    finder = GridPatchFinder(2, 0, 64, 64)
+    detector = TissueDetectorOTSUFast()
+    tile_sizes = []
+    render = AnnotationSet.render
+
+    def record_render(self, shape, factor, dtype=int, tile_size=None):
+        tile_sizes.append(tile_size)
+        return render(self, shape, factor, dtype, tile_size)
+
+    monkeypatch.setattr(AnnotationSet, "render", record_render)
+    for max_untiled_pixels in [2 ** 28, 0]:
+        index_slide(0, dataset, detector, finder, 64, None, max_untiled_pixels)
+    assert tile_sizes == [None, 64]
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+from pathgen.preprocess.patching import GridPatchFinder, MultiLevelPatchFinder
+from pathgen.utils.geometry import Size
+
+
+def test_grid_locations_are_stride_apart():
+    # labels at level 2 for a 64 pixel slide, patches of 16 pixels every 8 pixels
+    labels_image = np.ones((16, 16), dtype=int)
+    finder = GridPatchFinder(2, 0, 16, 8)
+    df, level, patch_size = finder(labels_image, Size(64, 64))
+    assert level == 0 and patch_size == 16
+    assert len(df) == 7 * 7
+    np.testing.assert_array_equal(np.unique(df["x"]), np.arange(0, 49, 8))
+    np.testing.assert_array_equal(np.unique(df["y"]), np.arange(0, 49, 8))
+    # the grid index and the location agree
+    np.testing.assert_array_equal(df.index % 7 * 8, df["x"])
+    np.testing.assert_array_equal(df.index // 7 * 8, df["y"])
+
+
+@pytest.mark.parametrize("patch_level", [0, 1])
+def test_single_spec_multi_level_matches_grid(patch_level):
+    rng = np.random.RandomState(0)
+    labels_image = rng.randint(0, 3, size=(40, 24)) * (rng.rand(40, 24) > 0.7)
+    slide_shape = Size(24 * 4, 40 * 4)
+    level_shape = Size(24 * 4 // 2 ** patch_level, 40 * 4 // 2 ** patch_level)
+    size, stride = 16 // 2 ** patch_level, 8 // 2 ** patch_level
+    grid = GridPatchFinder(2, patch_level, size, stride, border=2, jitter=1)
+    multi = MultiLevelPatchFinder(2, [(patch_level, size, stride)], border=2, jitter=1)
+    expected, level, patch_size = grid(labels_image, level_shape)
+    df, _, _ = multi(labels_image, slide_shape)
+    assert len(df) > 0 and level == patch_level
+    np.testing.assert_array_equal(df["x"], expected["x"])
+    np.testing.assert_array_equal(df["y"], expected["y"])
+    np.testing.assert_array_equal(df["label"], expected["label"])
+    assert (df["level"] == level).all() and (df["patch_size"] == patch_size).all()
+
+
+def test_grid_locations_are_at_level_0():
+    # patches of 8 pixels every 4 pixels at level 1, so 16 every 8 at level 0
+    labels_image = np.ones((16, 16), dtype=int)
+    finder = GridPatchFinder(2, 1, 8, 4)
+    df, level, patch_size = finder(labels_image, Size(32, 32))
+    assert level == 1 and patch_size == 8
+    np.testing.assert_array_equal(np.unique(df["x"]), np.arange(0, 49, 8))
+    np.testing.assert_array_equal(np.unique(df["y"]), np.arange(0, 49, 8))
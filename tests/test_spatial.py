@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+from pathgen.data.annotations.spatial import AnnotationIndex
+from pathgen.data.datasets.synthetic import make_synthetic
+from pathgen.data.slides import Region
+from pathgen.utils.geometry import Shape, Size
+
+dataset = make_synthetic("spatial", 1, 0, size=Size(8192, 6144), num_levels=6)
+
+
+@pytest.mark.parametrize("level, size", [(2, 64), (3, 48), (4, 32)])
+def test_area_fractions_match_rendering(level, size):
+    annotations = dataset.load_annotations(dataset[0][1])
+    factor = 2 ** level
+    image = annotations.render(Shape(6144 // factor, 8192 // factor), factor)
+    rows = range(0, image.shape[0] - size + 1, size)
+    cols = range(0, image.shape[1] - size + 1, size)
+    regions = [
+        Region.make(x * factor, y * factor, size, level) for y in rows for x in cols
+    ]
+
+    fractions = AnnotationIndex(annotations, cell_size=1024).area_fractions(regions)
+    expected = np.array(
+        [
+            np.bincount(image[y : y + size, x : x + size].ravel(), minlength=3)
+            for y in rows
+            for x in cols
+        ]
+    ) / (size * size)
+    assert (fractions[:, 1] > 0).any()
+    # polygon edges may rasterise a pixel differently in a window than in the whole
+    # image, so allow a row and a column of each region to differ
+    np.testing.assert_allclose(fractions, expected, atol=2 / size)
@@ -0,0 +1,53 @@
+import cv2
+import numpy as np
+import pytest
+
+from pathgen.data.datasets.registry import register_dataset
+from pathgen.data.datasets.synthetic import make_synthetic
+from pathgen.preprocess.patching import GridPatchFinder, index_slide
+from pathgen.preprocess.tissue_detection import (
+    TissueDetectorOTSU,
+    TissueDetectorOTSUFast,
+    TissueDetectorOTSUTiled,
+)
+from pathgen.utils.geometry import Size
+
+dataset = make_synthetic("tissue", 2, 1, size=Size(8192, 6144), num_levels=7)
+register_dataset(dataset)
+
+
+def test_synthetic_background_is_not_tissue():
+    finder = GridPatchFinder(4, 0, 256, 256, remove_background=False)
+    patchset = index_slide(0, dataset, TissueDetectorOTSU(), finder)
+    num_tissue = (patchset.df["label"] > 0).sum()
+    assert 0 < num_tissue < 0.5 * len(patchset.df)
+
+
+@pytest.mark.parametrize("slide_idx", [0, 2])
+@pytest.mark.parametrize("level", [4, 5, 6])
+def test_fast_detectors_match_skimage(slide_idx, level):
+    with dataset.borrow_slide(slide_idx) as slide:
+        thumbnail = slide.get_thumbnail(level)
+        expected = TissueDetectorOTSU()(thumbnail)
+        tiled = TissueDetectorOTSUTiled(tile_size=256).detect_slide(slide, level)
+    np.testing.assert_array_equal(TissueDetectorOTSUFast()(thumbnail), expected)
+    np.testing.assert_array_equal(tiled, expected)
+
+
+def textured_image(seed: int) -> np.ndarray:
+    # smooth random colours with noise, so many pixels are near the thresholds
+    rng = np.random.RandomState(seed)
+    small = rng.randint(0, 256, (60, 80, 3)).astype(np.uint8)
+    image = cv2.resize(small, (800, 600), interpolation=cv2.INTER_LINEAR)
+    image = image + rng.normal(0, 10, image.shape)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_fast_detector_matches_skimage_on_texture(seed):
+    image = textured_image(seed)
+    expected = TissueDetectorOTSU()(image)
+    assert 0 < expected.mean() < 1
+    np.testing.assert_array_equal(
+        TissueDetectorOTSUFast(chunk_rows=64)(image), expected
+    )